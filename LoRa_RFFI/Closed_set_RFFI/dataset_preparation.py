@@ -1,27 +1,86 @@
 import numpy as np
 import h5py
-from numpy import sum, sqrt
-from numpy.random import standard_normal, uniform
 
-from scipy import signal
+from scipy import signal, fft
 
 # In[]
 
-def awgn(data, snr_range):
-    pkt_num = data.shape[0]
-    SNRdB = uniform(snr_range[0], snr_range[-1], pkt_num)
-    for pktIdx in range(pkt_num):
-        s = data[pktIdx]
-        # SNRdB = uniform(snr_range[0],snr_range[-1])
-        SNR_linear = 10 ** (SNRdB[pktIdx] / 10)
-        P = sum(abs(s) ** 2) / len(s)
-        N0 = P / SNR_linear
-        n = sqrt(N0 / 2) * (standard_normal(len(s)) + 1j * standard_normal(len(s)))
-        data[pktIdx] = s + n
+def awgn(data, snr_range, seed=None, chunk_size=None):
+    '''
+    Add white Gaussian noise to every packet, in place.
+
+    INPUT:
+        DATA is the complex IQ samples (complex64 or complex128), one
+        packet per row. It is modified in place.
+
+        SNR_RANGE is the range the per-packet SNR (dB) is drawn from.
+
+        SEED makes the augmentation reproducible (int or np.random.Generator).
+
+        CHUNK_SIZE caps how many packets get their noise drawn at once.
+
+    RETURN:
+        DATA is the noisy IQ samples (same buffer as the input).
+    '''
+    rng = np.random.default_rng(seed)
+    pkt_num, pkt_len = data.shape
+    real_dtype = data.real.dtype
+    if chunk_size is None:
+        chunk_size = max(pkt_num, 1)
+
+    SNRdB = rng.uniform(snr_range[0], snr_range[-1], pkt_num)
+    SNR_linear = 10 ** (SNRdB / 10)
+    for start in range(0, pkt_num, chunk_size):
+        s = data[start:start + chunk_size]
+        # Per-packet signal power and noise spectral density.
+        P = np.mean(s.real ** 2 + s.imag ** 2, axis=1)
+        N0 = P / SNR_linear[start:start + chunk_size]
+        # Draw I and Q noise for the whole chunk in one call.
+        n = rng.standard_normal((s.shape[0], 2 * pkt_len), dtype=real_dtype).view(data.dtype)
+        n *= np.sqrt(N0 / 2).astype(real_dtype)[:, None]
+        s += n
 
     return data
 
 
+def read_rows(dataset, rows):
+    '''
+    Read selected rows of a 2-D HDF5 dataset.
+
+    h5py serves fancy indexing with an unsorted list point by point, which is
+    very slow. The rows are instead sorted, grouped into runs of consecutive
+    rows and each run is read as one contiguous hyperslab.
+
+    INPUT:
+        DATASET is the h5py dataset.
+
+        ROWS is the row indexes to read, in any order (duplicates allowed).
+
+    RETURN:
+        DATA is the selected rows, in the order of ROWS.
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    data = np.empty((len(unique_rows),) + dataset.shape[1:], dtype=dataset.dtype)
+    if len(unique_rows) == 0:
+        return data
+
+    # Boundaries of the runs of consecutive rows
+    breaks = np.flatnonzero(np.diff(unique_rows) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    stops = np.concatenate([breaks, [len(unique_rows)]])
+    for start, stop in zip(starts, stops):
+        first = unique_rows[start]
+        dataset.read_direct(data,
+                            np.s_[first:first + stop - start],
+                            np.s_[start:stop])
+
+    if np.array_equal(rows, unique_rows):
+        return data
+    return data[inverse]
+
+
+
 class LoadDataset():
     def __init__(self, ):
         self.dataset_name = 'data'
@@ -74,7 +133,7 @@ class LoadDataset():
             sample_index_dev = np.where(label == dev_idx)[0][pkt_range].tolist()
             sample_index_list.extend(sample_index_dev)
 
-        data = f[self.dataset_name][sample_index_list]
+        data = read_rows(f[self.dataset_name], sample_index_list)
         data = self._convert_to_complex(data)
 
         label = label[sample_index_list]
@@ -142,7 +201,47 @@ class ChannelIndSpectrogram():
 
         return chan_ind_spec_amp
 
-    def channel_ind_spectrogram(self, data):
+    def _gen_batch_channel_ind_spectrogram(self, data, win_len=256, overlap=128):
+        '''
+        _gen_batch_channel_ind_spectrogram converts a batch of packets to
+        channel independent spectrograms in one pass. Every packet is framed
+        with a strided (zero-copy) view and a single FFT is run over the
+        resulting (N, frames, win_len) array. The output matches the one of
+        _gen_single_channel_ind_spectrogram applied to each packet.
+
+        INPUT:
+            DATA is the complex IQ samples, one packet per row.
+
+            WIN_LEN is the window length used in STFT.
+
+            OVERLAP is the overlap length used in STFT.
+
+        RETURN:
+
+            CHAN_IND_SPEC_AMP is the genereated channel independent
+            spectrograms, shaped (N, win_len, frames - 1).
+        '''
+        # Frame all packets at once: (N, frames, win_len). Same framing as
+        # signal.stft with padded=False and boundary=None.
+        step = win_len - overlap
+        frames = np.lib.stride_tricks.sliding_window_view(data, win_len, axis=-1)[:, ::step]
+
+        # Short-time Fourier transform (boxcar window, 'spectrum' scaling as in signal.stft).
+        spec = fft.fft(frames, n=win_len, axis=-1) / win_len
+
+        # FFT shift to adjust the central frequency, then put frequency on rows.
+        spec = np.fft.fftshift(spec, axes=-1).transpose(0, 2, 1)
+
+        # Generate channel independent spectrogram.
+        chan_ind_spec = spec[:, :, 1:] / spec[:, :, :-1]
+
+        # Take the logarithm of the magnitude.
+        chan_ind_spec_amp = np.log10(np.abs(chan_ind_spec) ** 2)
+
+        return chan_ind_spec_amp
+
+    def channel_ind_spectrogram(self, data, win_len=256, overlap=128,
+                                batched=True, batch_size=1024):
         '''
         channel_ind_spectrogram converts IQ samples to channel independent
         spectrograms.
@@ -150,6 +249,16 @@ class ChannelIndSpectrogram():
         INPUT:
             DATA is the IQ samples.
 
+            WIN_LEN is the window length used in STFT.
+
+            OVERLAP is the overlap length used in STFT.
+
+            BATCHED selects the vectorized engine (default) over the
+            per-packet signal.stft loop.
+
+            BATCH_SIZE caps the number of packets transformed at once
+            in the batched engine (bounds temporary memory).
+
         RETURN:
             DATA_CHANNEL_IND_SPEC is channel independent spectrograms.
         '''
@@ -159,15 +268,24 @@ class ChannelIndSpectrogram():
 
         # Calculate the size of channel independent spectrograms.
         num_sample = data.shape[0]
-        num_row = int(256 * 0.4)
-        num_column = int(np.floor((data.shape[1] - 256) / 128 + 1) - 1)
+        num_row = int(win_len * 0.4)
+        num_column = int(np.floor((data.shape[1] - win_len) / (win_len - overlap) + 1) - 1)
         data_channel_ind_spec = np.zeros([num_sample, num_row, num_column, 1])
 
+        if batched:
+            # Convert blocks of packets (IQ samples) to channel independent spectrograms.
+            for start in range(0, num_sample, batch_size):
+                stop = min(start + batch_size, num_sample)
+                chan_ind_spec_amp = self._gen_batch_channel_ind_spectrogram(data[start:stop], win_len, overlap)
+                # Same crop as _spec_crop, applied on the frequency axis.
+                chan_ind_spec_amp = chan_ind_spec_amp[:, round(win_len * 0.3):round(win_len * 0.7)]
+                data_channel_ind_spec[start:stop, :, :, 0] = chan_ind_spec_amp
+            return data_channel_ind_spec
+
         # Convert each packet (IQ samples) to a channel independent spectrogram.
         for i in range(num_sample):
-            chan_ind_spec_amp = self._gen_single_channel_ind_spectrogram(data[i])
+            chan_ind_spec_amp = self._gen_single_channel_ind_spectrogram(data[i], win_len, overlap)
             chan_ind_spec_amp = self._spec_crop(chan_ind_spec_amp)
             data_channel_ind_spec[i, :, :, 0] = chan_ind_spec_amp
 
         return data_channel_ind_spec
-
@@ -3,8 +3,7 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 
 
-from sklearn.metrics import roc_curve, auc , confusion_matrix, accuracy_score
-from sklearn.neighbors import KNeighborsClassifier
+from sklearn.metrics import confusion_matrix, accuracy_score
 from sklearn.model_selection import train_test_split
 
 
@@ -15,6 +14,14 @@ from keras.optimizers import RMSprop
 
 from dataset_preparation import awgn, LoadDataset, ChannelIndSpectrogram
 from deep_learning_models import TripletNet, identity_loss
+from scoring import roc_eer_batch
+from knn_backends import make_knn_classifier
+
+# Enrollment matching: 'exact' (scikit-learn), 'ivf' (approximate index, see 
+# knn_backends.benchmark_recall) or 'centroid' (per-device centroids, see 
+# knn_backends.compare_centroid_knn)
+KNN_BACKEND = 'exact'
+KNN_PARAMS = {'n_neighbors': 15}
 
 
 #%%
@@ -181,7 +188,7 @@ def test_classification(
     del data_enrol
     
     # Create a K-NN classifier using the RFFs extracted from the enrollment dataset.
-    knnclf=KNeighborsClassifier(n_neighbors=15,metric='euclidean')
+    knnclf = make_knn_classifier(KNN_BACKEND, **KNN_PARAMS)
     knnclf.fit(feature_enrol, np.ravel(label_enrol))
     
     
@@ -269,18 +276,6 @@ def test_rogue_device_detection(
     '''
 
     
-    def _compute_eer(fpr,tpr,thresholds):
-        '''
-        _COMPUTE_EER returns equal error rate (EER) and the threshold to reach
-        EER point.
-        '''
-        fnr = 1-tpr
-        abs_diffs = np.abs(fpr - fnr)
-        min_index = np.argmin(abs_diffs)
-        eer = np.mean((fpr[min_index], fnr[min_index]))
-        
-        return eer, thresholds[min_index]
-    
     # Load RFF extractor.
     feature_extractor = load_model(feature_extractor_name, compile=False)
     
@@ -301,7 +296,7 @@ def test_rogue_device_detection(
     del data_enrol
     
     # Build a K-NN classifier.
-    knnclf=KNeighborsClassifier(n_neighbors=15,metric='euclidean')
+    knnclf = make_knn_classifier(KNN_BACKEND, **KNN_PARAMS)
     knnclf.fit(feature_enrol, np.ravel(label_enrol))
     
     # Load the test dataset of legitimate devices.
@@ -325,33 +320,28 @@ def test_rogue_device_detection(
     feature_test = feature_extractor.predict(data_test)
     del data_test
 
-    # Find the nearest 15 neighbors in the RFF database and calculate the 
-    # distances to them.
-    distances, indexes = knnclf.kneighbors(feature_test)
-    
-    # Calculate the average distance to the nearest 15 neighbors.
-    detection_score = distances.mean(axis =1)
+    if KNN_BACKEND == 'centroid':
+        # Distance to the nearest device centroid (one matrix multiply).
+        detection_score = knnclf.detection_score(feature_test)
+    else:
+        # Find the nearest 15 neighbors in the RFF database and calculate the 
+        # distances to them.
+        distances, indexes = knnclf.kneighbors(feature_test)
+        
+        # Calculate the average distance to the nearest 15 neighbors.
+        detection_score = distances.mean(axis =1)
 
     # Label the packets sent from legitimate devices as 1. The rest are sent by rogue devices
     # and are labeled as 0.
     true_label = np.zeros([len(label_test),1])
     true_label[(label_test <= dev_range_legitimate[-1]) & (label_test >= dev_range_legitimate[0])] = 1
     
-    # Compute receiver operating characteristic (ROC).
-    fpr, tpr, thresholds = roc_curve(true_label, detection_score, pos_label = 1)
-    
-    # The Euc. distance is used as the detection score. The lower the value, 
-    # the more similar it is. This is opposite with the probability or confidence 
-    # value used in scikit-learn roc_curve function. Therefore, we need to subtract 
-    # them from 1.
-    fpr = 1-fpr  
-    tpr = 1-tpr
-
-    # Compute EER.
-    eer, _ = _compute_eer(fpr,tpr,thresholds)
-    
-    # Compute AUC.
-    roc_auc = auc(fpr, tpr)
+    # Compute receiver operating characteristic (ROC), AUC and EER. The Euc. 
+    # distance is used as the detection score: the lower the value, the more 
+    # similar it is. roc_eer_batch also scores many stacked runs at once.
+    fpr, tpr, roc_auc, eer, _ = roc_eer_batch(detection_score[np.newaxis], 
+                                              np.ravel(true_label)[np.newaxis])
+    fpr, tpr, roc_auc, eer = fpr[0], tpr[0], roc_auc[0], eer[0]
     
     return fpr, tpr, roc_auc, eer
     
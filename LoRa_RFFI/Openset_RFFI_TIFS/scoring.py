@@ -0,0 +1,88 @@
+import warnings
+import numpy as np
+
+# In[]
+
+def roc_eer_batch(detection_score, true_label):
+    '''
+    roc_eer_batch computes the ROC curve, AUC, EER and EER threshold of many
+    rogue device detection runs at once, with a single sort and cumulative
+    sum over all of them.
+
+    INPUT:
+        DETECTION_SCORE is the stacked detection scores, shaped (runs, packets),
+        e.g. one row per (model, enrollment, test epoch) combination. As in
+        test_rogue_device_detection, the score is a distance: the lower the
+        value, the more likely the packet comes from a legitimate device.
+
+        TRUE_LABEL is 1 for packets of legitimate devices and 0 for rogue
+        devices, shaped (runs, packets) or (packets,) if shared by all runs.
+
+    RETURN:
+        FPR is the false positive rate of every run, shaped (runs, packets + 1).
+
+        TPR is the true positive rate of every run, shaped (runs, packets + 1).
+
+        ROC_AUC is the area under the ROC curve of every run.
+
+        EER is the equal error rate of every run.
+
+        EER_THRESHOLD is the detection score threshold reaching the EER point
+        (packets scoring at or below it are accepted as legitimate).
+
+        As with sklearn's roc_curve, a run without legitimate or without rogue
+        packets has an undefined TPR or FPR: a warning is raised and its
+        ROC_AUC, EER and EER_THRESHOLD are NaN.
+    '''
+    detection_score = np.atleast_2d(np.asarray(detection_score, dtype=float))
+    true_label = np.broadcast_to(np.asarray(true_label), detection_score.shape).astype(bool)
+    num_run, num_pkt = detection_score.shape
+
+    # Sort every run by increasing score: accepting the first j packets as
+    # legitimate is the decision at threshold score[j-1].
+    order = np.argsort(detection_score, axis=1, kind='stable')
+    sorted_score = np.take_along_axis(detection_score, order, axis=1)
+    sorted_label = np.take_along_axis(true_label, order, axis=1)
+
+    tp = np.cumsum(sorted_label, axis=1)
+    fp = np.cumsum(~sorted_label, axis=1)
+
+    # Tied scores form a single operating point: use the counts at the end
+    # of each group of equal scores.
+    last_of_group = np.ones((num_run, num_pkt), dtype=bool)
+    last_of_group[:, :-1] = sorted_score[:, 1:] != sorted_score[:, :-1]
+    group_end = np.where(last_of_group, np.arange(num_pkt), num_pkt - 1)
+    group_end = np.minimum.accumulate(group_end[:, ::-1], axis=1)[:, ::-1]
+    tp = np.take_along_axis(tp, group_end, axis=1)
+    fp = np.take_along_axis(fp, group_end, axis=1)
+
+    # Add the (0, 0) point (nothing accepted).
+    num_pos = tp[:, -1:]
+    num_neg = fp[:, -1:]
+    undefined = (num_pos[:, 0] == 0) | (num_neg[:, 0] == 0)
+    if np.any(undefined):
+        warnings.warn(f'{np.sum(undefined)} of {num_run} runs have no legitimate or no rogue '
+                      'packets: their ROC curve is undefined (NaN AUC and EER).', RuntimeWarning)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        tpr = np.concatenate([np.zeros((num_run, 1)), tp / num_pos], axis=1)
+        fpr = np.concatenate([np.zeros((num_run, 1)), fp / num_neg], axis=1)
+
+    # Area under the curve (trapezoidal rule).
+    roc_auc = np.sum(np.diff(fpr, axis=1) * (tpr[:, 1:] + tpr[:, :-1]) / 2, axis=1)
+
+    # Equal error rate: the point where FPR and FNR are the closest.
+    fnr = 1 - tpr
+    distance = np.abs(fpr - fnr)
+    distance[undefined] = 0
+    min_index = np.nanargmin(distance, axis=1)
+    rows = np.arange(num_run)
+    eer = (fpr[rows, min_index] + fnr[rows, min_index]) / 2
+
+    threshold = np.concatenate([np.full((num_run, 1), -np.inf), sorted_score], axis=1)
+    eer_threshold = threshold[rows, min_index]
+
+    roc_auc[undefined] = np.nan
+    eer[undefined] = np.nan
+    eer_threshold[undefined] = np.nan
+
+    return fpr, tpr, roc_auc, eer, eer_threshold
@@ -1,35 +1,131 @@
+import copy
 import numpy as np
 import h5py
-from numpy import sum,sqrt
-from numpy.random import standard_normal, uniform
-from scipy import signal
+from scipy import signal, fft
 import seaborn as sea
 import matplotlib.pyplot as plt
 
-def awgn(data, snr_range):
+# Dtype policies: precision -> (real dtype, complex dtype).
+# 'float64' keeps the original behaviour, 'float32' keeps IQ samples as 
+# complex64 and spectrograms as float32 from the HDF5 read up to the model.
+DTYPE_POLICIES = {
+    'float64': (np.float64, np.complex128),
+    'float32': (np.float32, np.complex64),
+}
+
+def get_dtype_policy(precision):
+    '''Return the (real dtype, complex dtype) pair for a given precision.'''
+    if precision not in DTYPE_POLICIES:
+        raise Exception(f'Invalid precision. Accepted options: {list(DTYPE_POLICIES.keys())}')
+    return DTYPE_POLICIES[precision]
+
+def awgn(data, snr_range, seed=None, chunk_size=None):
+    '''
+    Add white Gaussian noise to every packet, in place.
     
-    pkt_num = data.shape[0]
-    SNRdB = uniform(snr_range[0],snr_range[-1],pkt_num)
-    for pktIdx in range(pkt_num):
-        s = data[pktIdx]
-        # SNRdB = uniform(snr_range[0],snr_range[-1])
-        SNR_linear = 10**(SNRdB[pktIdx]/10)
-        P= sum(abs(s)**2)/len(s)
-        N0=P/SNR_linear
-        n = sqrt(N0/2)*(standard_normal(len(s))+1j*standard_normal(len(s)))
-        data[pktIdx] = s + n
+    INPUT:
+        DATA is the complex IQ samples (complex64 or complex128), one 
+        packet per row. It is modified in place.
+        
+        SNR_RANGE is the range the per-packet SNR (dB) is drawn from.
+        
+        SEED makes the augmentation reproducible (int or np.random.Generator).
+        
+        CHUNK_SIZE caps how many packets get their noise drawn at once.
+        
+    RETURN:
+        DATA is the noisy IQ samples (same buffer as the input).
+    '''
+    rng = np.random.default_rng(seed)
+    pkt_num, pkt_len = data.shape
+    real_dtype = data.real.dtype
+    if chunk_size is None:
+        chunk_size = max(pkt_num, 1)
+    
+    SNRdB = rng.uniform(snr_range[0],snr_range[-1],pkt_num)
+    SNR_linear = 10**(SNRdB/10)
+    for start in range(0, pkt_num, chunk_size):
+        s = data[start:start + chunk_size]
+        # Per-packet signal power and noise spectral density.
+        P = np.mean(s.real**2 + s.imag**2, axis=1)
+        N0 = P/SNR_linear[start:start + chunk_size]
+        # Draw I and Q noise for the whole chunk in one call.
+        n = rng.standard_normal((s.shape[0], 2*pkt_len), dtype=real_dtype).view(data.dtype)
+        n *= np.sqrt(N0/2).astype(real_dtype)[:, None]
+        s += n
 
     return data 
 
+def _packet_positions(count, pkt_range):
+    '''Positions of the selected packets among the COUNT packets of a device.'''
+    if pkt_range is None:
+        return np.arange(count)
+    if isinstance(pkt_range, slice):
+        return np.arange(count)[pkt_range]
+    pkt_range = np.asarray(pkt_range, dtype=int)
+    return pkt_range[(pkt_range >= 0) & (pkt_range < count)]
+
+def read_rows(dataset, rows, dtype):
+    '''
+    Read selected rows of a 2-D HDF5 dataset.
+    
+    h5py serves fancy indexing with an unsorted list point by point, which is 
+    very slow. The rows are instead sorted, grouped into runs of consecutive 
+    rows and each run is read as one contiguous hyperslab.
+    
+    INPUT:
+        DATASET is the h5py dataset.
+        
+        ROWS is the row indexes to read, in any order (duplicates allowed).
+        
+        DTYPE is the dtype of the returned array (converted inside HDF5).
+        
+    RETURN:
+        DATA is the selected rows, in the order of ROWS.
+    '''
+    rows = np.asarray(rows, dtype=np.int64)
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    data = np.empty((len(unique_rows),) + dataset.shape[1:], dtype=dtype)
+    if len(unique_rows) == 0:
+        return data
+    
+    # Boundaries of the runs of consecutive rows
+    breaks = np.flatnonzero(np.diff(unique_rows) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    stops = np.concatenate([breaks, [len(unique_rows)]])
+    for start, stop in zip(starts, stops):
+        first = unique_rows[start]
+        dataset.read_direct(data, 
+                            np.s_[first:first + stop - start], 
+                            np.s_[start:stop])
+    
+    if np.array_equal(rows, unique_rows):
+        return data
+    return data[inverse]
+
 class LoadDataset():
-    def __init__(self,):
+    def __init__(self, precision='float64'):
         self.dataset_name = 'data'
         self.labelset_name = 'label'
         self.rssiset_name = 'rssi'
+        self.label_index_name = 'label_index'
+        self.real_dtype, self.complex_dtype = get_dtype_policy(precision)
 
     def _convert_to_complex(self, data):
         '''Convert the loaded data to complex IQ samples.'''
-        return data[:, 0::2] + 1j * data[:, 1::2]
+        # Interleaved I/Q rows can be reinterpreted as complex without a copy.
+        data = np.ascontiguousarray(data, dtype=self.real_dtype)
+        return data.view(self.complex_dtype)
+
+    def _format_version(self, f):
+        '''On-disk layout version: 1 (plain float64) or 2 (chunked, label-indexed).'''
+        return int(f.attrs.get('format_version', 1))
+
+    def _read_data(self, dataset):
+        '''Read a full dataset, converting to the policy dtype inside HDF5.'''
+        data = np.empty(dataset.shape, dtype=self.real_dtype)
+        dataset.read_direct(data)
+        return data
 
     def shuffle(self, data, labels):
         # Produce a new order for elements
@@ -41,21 +137,65 @@ class LoadDataset():
 
         return data, labels
     
-    def load_iq_samples(self, file_path):
+    def _device_rows(self, f, label):
+        '''
+        Return (labels, offsets, counts, order): the rows of device labels[i] 
+        are order[offsets[i]:offsets[i] + counts[i]], in file order. v2 files 
+        store one contiguous row range per device and come with the index, 
+        other files get it built from the label set.
+        '''
+        if self.label_index_name in f:
+            label_index = f[self.label_index_name]
+            labels = label_index['labels'][:]
+            offsets = label_index['offsets'][:]
+            counts = label_index['counts'][:]
+            order = np.arange(len(label))
+        else:
+            order = np.argsort(label.ravel(), kind='stable')
+            labels, offsets, counts = np.unique(label.ravel()[order], 
+                                                return_index=True, 
+                                                return_counts=True)
+        return labels, offsets, counts, order
+
+    def _select_rows(self, f, label, dev_range, pkt_range):
+        '''Row indexes of the selected devices and packets, in DEV_RANGE order.'''
+        labels, offsets, counts, order = self._device_rows(f, label)
+        dev_pos = {int(dev): i for i, dev in enumerate(labels)}
+        
+        if dev_range is None:
+            dev_range = labels
+        
+        rows = []
+        for dev_idx in dev_range:
+            # Devices absent from this file are skipped.
+            if int(dev_idx) not in dev_pos:
+                continue
+            i = dev_pos[int(dev_idx)]
+            pkt_idx = _packet_positions(counts[i], pkt_range)
+            rows.append(order[offsets[i] + pkt_idx])
+        
+        return np.concatenate(rows) if rows else np.empty(0, dtype=int)
+    
+    def load_iq_samples(self, file_path, dev_range=None, pkt_range=None):
         '''
-        Load IQ samples from a dataset.
+        Load IQ samples from a dataset. When devices or packets are selected, 
+        only their rows are read from disk.
         
         INPUT:
             FILE_PATH is the dataset path.
             
-            DEV_RANGE specifies the loaded device range.
+            DEV_RANGE specifies the loaded device range (labels). None loads 
+            all devices; devices absent from the file are skipped.
             
-            PKT_RANGE specifies the loaded packets range.
+            PKT_RANGE specifies the loaded packets range of every device. None 
+            loads all packets; packets past a device's count are skipped.
             
         RETURN:
             DATA is the laoded complex IQ samples.
             
             LABLE is the true label of each received packet.
+            
+            RSSI is the RSSI of each received packet.
         '''
         
         f = h5py.File(file_path,'r')
@@ -63,43 +203,179 @@ class LoadDataset():
         label = f[self.labelset_name][:]
         label = label.astype(int)
 
-        # # If the list of devices isn't specified - loop through all of the available ones
-        # if dev_range is None:
-        #     dev_range = set(label.flatten())
+        # v2 files store labels and RSSI as 1-D arrays: keep the v1 (N, 1) shape
+        if self._format_version(f) >= 2:
+            rssi = rssi.reshape(-1, 1)
+            label = label.reshape(-1, 1)
 
-        # # Filter indexes of frames to keep based on dev_range
-        # frame_idx_filtered = []
-        # for dev_idx in dev_range:
-        #     # Extract only the specified devices, and for each only pkt_range frames
-        #     frame_idx_device = np.where(label==int(dev_idx))[0][pkt_range]
-        #     frame_idx_filtered.extend(frame_idx_device)
-    
-        # Retrieve data from the dataset
-        data = f[self.dataset_name][:]
+        if dev_range is None and pkt_range is None:
+            # Retrieve the whole dataset
+            data = self._read_data(f[self.dataset_name])
+        else:
+            # Retrieve only the rows of the selected devices and packets
+            sample_index = self._select_rows(f, label, dev_range, pkt_range)
+            data = read_rows(f[self.dataset_name], sample_index, self.real_dtype)
+            label = label[sample_index]
+            rssi = rssi[sample_index]
 
         # Convert from interleaved doubles to complex values
         data = self._convert_to_complex(data)
-        
-        # # Filter the dataset based on dev_range and pkt_range
-        # label = label[frame_idx_filtered]
-        # data = data[frame_idx_filtered, :]
           
         f.close()
         return data, label, rssi
 
+class LazyRFDataset():
+    '''
+    Read-only view over the packets of several HDF5 datasets (e.g. every 
+    node{rx}_{session}.h5 of a campaign), without loading them in memory.
+    
+    The selected packets of all files share one index (0 to N-1) and one 
+    label space (the node ids stored in the files). Rows are only read from 
+    disk when the dataset is indexed: contiguous v1 datasets through a numpy 
+    memmap, chunked v2 datasets through sorted hyperslab reads and the HDF5 
+    chunk cache. It can be passed in place of an array to the TripletNet and 
+    NPairNet generators.
+    '''
+    def __init__(self, file_paths, dev_range=None, pkt_range=None, precision='float64', 
+                 transform=None, chunk_cache_bytes=64 * 2**20):
+        '''
+        INPUT:
+            FILE_PATHS is the list of dataset paths.
+            
+            DEV_RANGE, PKT_RANGE select the devices and packets of every file 
+            (see LoadDataset.load_iq_samples).
+            
+            PRECISION is the dtype policy of the IQ samples.
+            
+            TRANSFORM (optional) converts every block of IQ samples read, e.g. 
+            AWGN + channel independent spectrograms.
+            
+            CHUNK_CACHE_BYTES is the HDF5 chunk cache size of every file.
+        '''
+        self.file_paths = list(file_paths)
+        self.transform = transform
+        self._loader = LoadDataset(precision = precision)
+        self._files = []
+        self._sources = []
+        
+        file_index, row_index, label, rssi = [], [], [], []
+        row_len = None
+        for i, file_path in enumerate(self.file_paths):
+            f = h5py.File(file_path, 'r', rdcc_nbytes = chunk_cache_bytes)
+            dataset = f[self._loader.dataset_name]
+            if row_len is not None and dataset.shape[1] != row_len:
+                raise Exception(f'Packet length of {file_path} differs from the other datasets.')
+            row_len = dataset.shape[1]
+            
+            file_label = f[self._loader.labelset_name][:].astype(int).reshape(-1, 1)
+            file_rssi = f[self._loader.rssiset_name][:].reshape(-1, 1)
+            rows = self._loader._select_rows(f, file_label, dev_range, pkt_range)
+            
+            file_index.append(np.full(len(rows), i))
+            row_index.append(rows)
+            label.append(file_label[rows])
+            rssi.append(file_rssi[rows])
+            self._files.append(f)
+            self._sources.append(self._row_source(dataset))
+        
+        self.file_index = np.concatenate(file_index)
+        self.row_index = np.concatenate(row_index)
+        self.label = np.concatenate(label)
+        self.rssi = np.concatenate(rssi)
+        self._row_len = row_len
+        
+        if len(self) == 0:
+            raise Exception('No packets selected in the given datasets.')
+        
+        # Shape of a single (transformed) sample
+        self.sample_shape = np.shape(self[:1])[1:]
+    
+    @property
+    def shape(self):
+        return (len(self),) + self.sample_shape
+    
+    @property
+    def labels(self):
+        '''The global label space: every device present in the view.'''
+        return np.unique(self.label)
+    
+    def __len__(self):
+        return len(self.row_index)
+    
+    def __getitem__(self, index):
+        '''
+        Read the packets at INDEX (int, slice or integer array of any shape) 
+        and apply the transform. The result has shape INDEX.shape + sample shape.
+        '''
+        if isinstance(index, slice):
+            index = np.arange(len(self))[index]
+        index = np.asarray(index)
+        
+        data = self._read_iq(index.ravel())
+        if self.transform is not None:
+            data = self.transform(data)
+        data = np.asarray(data)
+        
+        return data.reshape(index.shape + data.shape[1:])
+    
+    def _row_source(self, dataset):
+        '''A numpy memmap of contiguous, uncompressed datasets, else the h5py dataset.'''
+        offset = dataset.id.get_offset()
+        if dataset.chunks is None and offset is not None:
+            return np.memmap(dataset.file.filename, 
+                             dtype = dataset.dtype, 
+                             mode = 'r', 
+                             shape = dataset.shape, 
+                             offset = offset)
+        return dataset
+    
+    def _read_iq(self, index):
+        '''Complex IQ samples of the packets at (1-D) INDEX, in order.'''
+        data = np.empty((len(index), self._row_len), dtype=self._loader.real_dtype)
+        file_index = self.file_index[index]
+        
+        # One sorted read per file
+        for i in np.unique(file_index):
+            pos = np.flatnonzero(file_index == i)
+            rows = self.row_index[index[pos]]
+            source = self._sources[i]
+            if isinstance(source, np.memmap):
+                data[pos] = source[rows]
+            else:
+                data[pos] = read_rows(source, rows, self._loader.real_dtype)
+        
+        return self._loader._convert_to_complex(data)
+    
+    def subset(self, index):
+        '''Return a view over the packets at INDEX, sharing the open files.'''
+        view = copy.copy(self)
+        view.file_index = self.file_index[index]
+        view.row_index = self.row_index[index]
+        view.label = self.label[index]
+        view.rssi = self.rssi[index]
+        return view
+    
+    def split(self, test_size=0.1, seed=None):
+        '''Randomly split the view into (train, test) views.'''
+        order = np.random.default_rng(seed).permutation(len(self))
+        num_test = int(round(len(self) * test_size))
+        return self.subset(np.sort(order[num_test:])), self.subset(np.sort(order[:num_test]))
+    
+    def close(self):
+        for f in self._files:
+            f.close()
+
 class ChannelIndSpectrogram():
-    def __init__(self,):
-        pass
+    def __init__(self, precision='float64'):
+        self.real_dtype, self.complex_dtype = get_dtype_policy(precision)
     
     def _normalization(self,data):
         ''' Normalize the signal.'''
-        s_norm = np.zeros(data.shape, dtype=complex)
+        data = np.asarray(data, dtype=self.complex_dtype)
         
-        for i in range(data.shape[0]):
-        
-            sig_amplitude = np.abs(data[i])
-            rms = np.sqrt(np.mean(sig_amplitude**2))
-            s_norm[i] = data[i]/rms
+        sig_amplitude = np.abs(data)
+        rms = np.sqrt(np.mean(sig_amplitude**2, axis=1, keepdims=True))
+        s_norm = data/rms
         
         return s_norm        
 
@@ -148,7 +424,47 @@ class ChannelIndSpectrogram():
                   
         return chan_ind_spec_amp
     
-    def channel_ind_spectrogram(self, data, row=50, col=14):
+    def _gen_batch_channel_ind_spectrogram(self, data, win_len=256, overlap=128):
+        '''
+        _gen_batch_channel_ind_spectrogram converts a batch of packets to 
+        channel independent spectrograms in one pass. Every packet is framed 
+        with a strided (zero-copy) view and a single FFT is run over the 
+        resulting (N, frames, win_len) array. The output matches the one of
+        _gen_single_channel_ind_spectrogram applied to each packet.
+        
+        INPUT:
+            DATA is the complex IQ samples, one packet per row.
+            
+            WIN_LEN is the window length used in STFT.
+            
+            OVERLAP is the overlap length used in STFT.
+            
+        RETURN:
+            
+            CHAN_IND_SPEC_AMP is the genereated channel independent 
+            spectrograms, shaped (N, win_len, frames - 1).
+        '''
+        # Frame all packets at once: (N, frames, win_len). Same framing as 
+        # signal.stft with padded=False and boundary=None.
+        step = win_len - overlap
+        frames = np.lib.stride_tricks.sliding_window_view(data, win_len, axis=-1)[:, ::step]
+        
+        # Short-time Fourier transform (boxcar window, 'spectrum' scaling as in signal.stft).
+        spec = fft.fft(frames, n=win_len, axis=-1) / win_len
+        
+        # FFT shift to adjust the central frequency, then put frequency on rows.
+        spec = np.fft.fftshift(spec, axes=-1).transpose(0, 2, 1)
+        
+        # Generate channel independent spectrogram.
+        chan_ind_spec = spec[:,:,1:]/spec[:,:,:-1]
+        
+        # Take the logarithm of the magnitude.
+        chan_ind_spec_amp = np.log10(np.abs(chan_ind_spec)**2)
+        
+        return chan_ind_spec_amp
+    
+    def channel_ind_spectrogram(self, data, row=50, col=14, win_len=50, overlap=25, 
+                                batched=True, batch_size=4096):
         '''
         channel_ind_spectrogram converts IQ samples to channel independent 
         spectrograms.
@@ -156,6 +472,18 @@ class ChannelIndSpectrogram():
         INPUT:
             DATA is the IQ samples.
             
+            ROW, COL are the size of a single spectrogram.
+            
+            WIN_LEN is the window length used in STFT.
+            
+            OVERLAP is the overlap length used in STFT.
+            
+            BATCHED selects the vectorized engine (default) over the 
+            per-packet signal.stft loop.
+            
+            BATCH_SIZE caps the number of packets transformed at once 
+            in the batched engine (bounds temporary memory).
+            
         RETURN:
             DATA_CHANNEL_IND_SPEC is channel independent spectrograms.
         '''
@@ -167,13 +495,20 @@ class ChannelIndSpectrogram():
         num_row = row # int(256*0.4) # nfft (how many subcarriers)
         # num_column = 38 #int(np.floor((8192-256)/128 + 1) - 1) # of windows - 1
         num_column = col
-        data_channel_ind_spec = np.zeros([num_sample, num_row, num_column, 1])
+        data_channel_ind_spec = np.zeros([num_sample, num_row, num_column, 1], dtype=self.real_dtype)
+        
+        if batched:
+            # Convert blocks of packets (IQ samples) to channel independent spectrograms.
+            for start in range(0, num_sample, batch_size):
+                stop = min(start + batch_size, num_sample)
+                chan_ind_spec_amp = self._gen_batch_channel_ind_spectrogram(data[start:stop], win_len=win_len, overlap=overlap)
+                data_channel_ind_spec[start:stop,:,:,0] = chan_ind_spec_amp
+            return data_channel_ind_spec
         
         # Convert each packet (IQ samples) to a channel independent spectrogram.
         for i in range(num_sample):
-            chan_ind_spec_amp = self._gen_single_channel_ind_spectrogram(data[i], win_len=50, overlap=25)
+            chan_ind_spec_amp = self._gen_single_channel_ind_spectrogram(data[i], win_len=win_len, overlap=overlap)
             # chan_ind_spec_amp = self._spec_crop(chan_ind_spec_amp)
             data_channel_ind_spec[i,:,:,0] = chan_ind_spec_amp
             
-        return data_channel_ind_spec
-
+        return data_channel_ind_spec
\ No newline at end of file
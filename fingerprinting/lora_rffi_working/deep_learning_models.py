@@ -1,4 +1,5 @@
 import numpy as np
+import tensorflow as tf
 
 from keras import backend as K
 from keras.models import Model
@@ -28,11 +29,81 @@ def resblock(x, kernelsize, filters, first_layer = False):
 def identity_loss(y_true, y_pred):
     return K.mean(y_pred)           
 
+def build_label_index(label, dev_range):
+    """Group sample indexes by device, once per dataset. The samples of 
+    dev_range[i] are index[offsets[i]:offsets[i] + counts[i]]."""
+    label = np.ravel(label)
+    dev_range = np.asarray(dev_range)
+
+    index = np.argsort(label, kind='stable')
+    sorted_label = label[index]
+    offsets = np.searchsorted(sorted_label, dev_range, side='left')
+    counts = np.searchsorted(sorted_label, dev_range, side='right') - offsets
+
+    if np.any(counts == 0):
+        raise Exception(f'No samples found for devices {dev_range[counts == 0]}')
+
+    return index, offsets, counts
+
+def sample_label_index(label_index, dev_pos):
+    """Draw one random sample index for every device position in dev_pos 
+    (positions within dev_range). Works on arrays of any shape."""
+    index, offsets, counts = label_index
+    dev_pos = np.asarray(dev_pos)
+    pick = np.random.randint(0, counts[dev_pos])
+    return index[offsets[dev_pos] + pick]
+
+def as_float32(data):
+    """Cast in-memory data once to float32 (no copy if it already is). Lazy 
+    datasets (e.g. LazyRFDataset) are returned as is: they are indexed per 
+    batch, so only the sampled rows are ever read."""
+    if isinstance(data, (np.ndarray, list, tuple)):
+        return np.asarray(data, dtype='float32')
+    return data
+
+def create_tf_dataset(sample_batch, data, batchsize, num_parallel_calls=tf.data.AUTOTUNE, 
+                      prefetch=tf.data.AUTOTUNE, transform=None):
+    """Build an endless tf.data pipeline of ([X_1, ..., X_k], dummy_label) batches, 
+    the same structure create_generator yields. 
+    
+    sample_batch(batchsize) returns sample indexes of shape (k, batchsize). 
+    transform (optional) converts a gathered block of samples into model inputs, 
+    e.g. IQ samples -> AWGN -> channel independent spectrograms. Batches are 
+    assembled in num_parallel_calls threads and prefetched, so that batch 
+    assembly overlaps with model steps."""
+    num_inputs = sample_batch(1).shape[0]
+    if transform is None:
+        sample_shape = tuple(data.shape[1:])
+    else:
+        # Probe the output shape on a copy (transforms may work in place)
+        sample_shape = tuple(np.shape(transform(data[:1].copy()))[1:])
+
+    def assemble_batch(_):
+        idx = sample_batch(batchsize)
+        batch = data[idx.ravel()]
+        if transform is not None:
+            batch = transform(batch)
+        batch = np.asarray(batch, dtype='float32').reshape((num_inputs, batchsize) + sample_shape)
+        return tuple(batch)
+
+    def tf_assemble_batch(i):
+        batch = tf.numpy_function(assemble_batch, [i], [tf.float32] * num_inputs)
+        for x in batch:
+            x.set_shape((batchsize,) + sample_shape)
+        # a "dummy" label which will come in to our identity loss
+        return tuple(batch), tf.ones([batchsize])
+
+    dataset = tf.data.Dataset.from_tensors(np.int64(0)).repeat()
+    dataset = dataset.map(tf_assemble_batch, 
+                          num_parallel_calls=num_parallel_calls, 
+                          deterministic=False)
+    return dataset.prefetch(prefetch)
+
 class TripletNet():
     def __init__(self):
         pass
         
-    def create_triplet_net(self, embedding_net, alpha, tough_coef):
+    def create_triplet_net(self, embedding_net, alpha, tough_coef = 1.0):
         
         #        embedding_net = encoder()
         self.alpha = alpha
@@ -65,6 +136,43 @@ class TripletNet():
         basic_loss = pos_dist-neg_dist + self.alpha
         loss = K.maximum(basic_loss,0.0)
         return loss
+
+    def create_batch_hard_net(self, embedding_net, alpha, tough_coef = 1.0):
+        """Batch-hard mode: the RFF extractor itself is trained, one forward 
+        pass per P x K batch, with batch_hard_triplet_loss as the loss. 
+        Use together with create_pk_generator."""
+        self.alpha = alpha
+        self.tough_coef = tough_coef
+        return embedding_net
+
+    def batch_hard_triplet_loss(self, y_true, y_pred):
+        """Online triplet mining. For every anchor in the batch, pick the 
+        hardest positive (farthest, same label) and hardest negative (closest, 
+        different label) among the batch embeddings. y_true holds the labels."""
+        labels = tf.reshape(y_true, [-1])
+        embeddings = y_pred
+
+        # Pairwise squared distances. Embeddings are L2-normalized: |a-b|^2 = 2 - 2a.b
+        dist = 2.0 - 2.0 * tf.matmul(embeddings, embeddings, transpose_b=True)
+        dist = K.maximum(dist, 0.0)
+
+        same = tf.equal(labels[:, None], labels[None, :])
+        not_self = tf.logical_not(tf.eye(tf.shape(labels)[0], dtype=tf.bool))
+
+        # Hardest positive: largest distance to a sample of the same device.
+        pos_mask = tf.cast(tf.logical_and(same, not_self), dist.dtype)
+        pos_dist = K.max(dist * pos_mask, axis=1)
+
+        # Hardest negative: smallest distance to a sample of another device 
+        # (same-device entries are pushed above the maximum distance of 4).
+        neg_dist = K.min(dist + 4.0 * tf.cast(same, dist.dtype), axis=1)
+
+        # Let's make it harder by artificially worsening the distances
+        neg_dist = neg_dist * self.tough_coef
+
+        basic_loss = pos_dist-neg_dist + self.alpha
+        loss = K.maximum(basic_loss,0.0)
+        return loss
     
     def feature_extractor(self, datashape):
             
@@ -112,34 +220,71 @@ class TripletNet():
     def call_sample(self,label_name):
         """Choose an image from our training or test data with the
         given label."""
-        num_sample = len(self.label)
-        idx = np.random.randint(num_sample)
-        while self.label[idx] != label_name:
-            # keep searching randomly!
-            idx = np.random.randint(num_sample) 
+        idx = sample_label_index(self.label_index, self.dev_pos[label_name])
         return self.data[idx]
 
+    def get_triplet_batch(self, batchsize):
+        """Draw sample indexes for a whole batch of triplets at once.
+        Returns an array of shape (3, batchsize): anchors, positives, negatives."""
+        num_dev = len(self.dev_range)
 
-    def create_generator(self, batchsize, dev_range, data, label):
-        """Generate a triplets generator for training."""
+        # Anchor devices, and a negative device that is guaranteed to differ.
+        a = np.random.randint(num_dev, size=batchsize)
+        n = (a + np.random.randint(1, num_dev, size=batchsize)) % num_dev
+
+        return sample_label_index(self.label_index, np.stack([a, a, n]))
+
+
+    def get_pk_batch(self, num_dev, num_sample):
+        """Draw sample indexes for a P x K batch: num_dev distinct devices, 
+        num_sample samples each. Returns (indexes, device positions)."""
+        num_dev = min(num_dev, len(self.dev_range))
+        dev_pos = np.random.permutation(len(self.dev_range))[:num_dev]
+        dev_pos = np.repeat(dev_pos, num_sample)
+
+        return sample_label_index(self.label_index, dev_pos), dev_pos
+
+    def create_pk_generator(self, num_dev, num_sample, dev_range, data, label):
+        """Generate P x K batches (samples, device positions) for batch-hard training."""
+        # Cast once to float32 (no copy if the spectrograms already are).
+        self._init_sampling(dev_range, as_float32(data), label)
+
+        while True:
+            idx, dev_pos = self.get_pk_batch(num_dev, num_sample)
+            yield self.data[idx], dev_pos.astype('float32')
+
+    def _init_sampling(self, dev_range, data, label):
+        """Store the dataset and build the per-device index (once), so that 
+        sampling is a direct pick."""
         self.data = data
         self.label = label
         self.dev_range = dev_range
+
+        if len(dev_range) < 2:
+            raise Exception('At least two devices are required to build triplets.')
+
+        self.label_index = build_label_index(label, dev_range)
+        self.dev_pos = {dev: i for i, dev in enumerate(np.ravel(dev_range))}
+
+    def create_dataset(self, batchsize, dev_range, data, label, 
+                       num_parallel_calls=tf.data.AUTOTUNE, prefetch=tf.data.AUTOTUNE, transform=None):
+        """tf.data alternative to create_generator, yielding the same [A, P, N] batches.
+        With a transform, DATA may hold raw IQ samples that are converted per batch."""
+        if transform is None:
+            data = as_float32(data)
+        self._init_sampling(dev_range, data, label)
+
+        return create_tf_dataset(self.get_triplet_batch, self.data, batchsize, 
+                                 num_parallel_calls, prefetch, transform)
+
+    def create_generator(self, batchsize, dev_range, data, label):
+        """Generate a triplets generator for training."""
+        # Cast once to float32 (no copy if the spectrograms already are).
+        self._init_sampling(dev_range, as_float32(data), label)
         
         while True:
-            list_a = []
-            list_p = []
-            list_n = []
-
-            for i in range(batchsize):
-                a, p, n = self.get_triplet()
-                list_a.append(a)
-                list_p.append(p)
-                list_n.append(n)
-            
-            A = np.array(list_a, dtype='float32')
-            P = np.array(list_p, dtype='float32')
-            N = np.array(list_n, dtype='float32')
+            # One fancy-index gather for the whole batch: (3, batchsize, ...)
+            A, P, N = self.data[self.get_triplet_batch(batchsize)]
             
             # a "dummy" label which will come in to our identity loss
             # function below as y_true. We'll ignore it.
@@ -170,24 +315,34 @@ class NPairNet():
         model = Model(inputs=inputs, outputs=outputs)
         return model 
 
-    def create_npair_net(self, feature_extractor, alpha, num_neg, loss_type):
+    def create_npair_net(self, feature_extractor, alpha, num_neg, loss_type, single_pass = False):
         self.num_neg = num_neg
         self.alpha = alpha
 
-        # The inputs are: [A, P, N1, ..., NN]
-        model_inputs = [Input([self.datashape[1],self.datashape[2],self.datashape[3]]) for _ in np.arange(self.num_neg + 2)]
-        loss_inputs = [feature_extractor(input) for input in model_inputs]
-
         if loss_type == 'triplet_loss':
-            model_outputs = Lambda(self.triplet_loss)(loss_inputs)
+            loss_fn = self.triplet_loss
         elif loss_type == 'n_loss':
-            model_outputs = Lambda(self.n_loss)(loss_inputs)
+            loss_fn = self.n_loss
         elif loss_type == 'quadruplet_loss':
-            model_outputs = Lambda(self.quadruplet_loss)(loss_inputs)
+            loss_fn = self.quadruplet_loss
         elif loss_type == 'quintuplet_loss':
-            model_outputs = Lambda(self.quintuplet_loss)(loss_inputs)
+            loss_fn = self.quintuplet_loss
         else: raise Exception('Invalid loss function type. Accepted options: [triplet_loss, quadruplet_loss, quintuplet_loss, n_loss]')
 
+        # The inputs are: [A, P, N1, ..., NN]
+        num_inputs = self.num_neg + 2
+        model_inputs = [Input([self.datashape[1],self.datashape[2],self.datashape[3]]) for _ in np.arange(num_inputs)]
+
+        if single_pass:
+            # Stack all inputs along the batch axis, embed them in one call of the
+            # (shared) feature extractor, then split back into [A, P, N1, ..., NN].
+            stacked_inputs = Lambda(lambda x: K.concatenate(x, axis=0))(model_inputs)
+            embeddings = feature_extractor(stacked_inputs)
+            model_outputs = Lambda(lambda x: loss_fn(tf.split(x, num_inputs, axis=0)))(embeddings)
+        else:
+            loss_inputs = [feature_extractor(input) for input in model_inputs]
+            model_outputs = Lambda(loss_fn)(loss_inputs)
+
         print(f'Applying {loss_type}')
 
         return Model(inputs = model_inputs, outputs = model_outputs)
@@ -242,34 +397,51 @@ class NPairNet():
 
         return loss
     
-    def create_generator(self, batchsize, dev_range, data, label, npair_type):
+    def _init_sampling(self, dev_range, data, label, npair_type):
+        # Store the dataset, build the per-device index (once) and return the batch sampler
         self.data = data
         self.label = label
         self.dev_range = dev_range
 
+        if npair_type == 'samedev':
+            get_npair_batch = self.get_npair_samedev_batch
+            min_dev = 2
+        elif npair_type == 'diffdev':
+            get_npair_batch = self.get_npair_diffdev_batch
+            min_dev = self.num_neg + 1
+        else: 
+            raise Exception('Invalid npair type. Accepted values: [samedev, diffdev]') 
+
+        if len(dev_range) < min_dev:
+            raise Exception(f'At least {min_dev} devices are required for {npair_type} npairs.')
+
+        # Per-device index (built once), so that sampling is a direct pick.
+        self.label_index = build_label_index(label, dev_range)
+        self.dev_pos = {dev: i for i, dev in enumerate(np.ravel(dev_range))}
+
+        return get_npair_batch
+
+    # tf.data alternative to create_generator, yielding the same [A, P, N1, ..., NN] batches.
+    # With a transform, data may hold raw IQ samples that are converted per batch.
+    def create_dataset(self, batchsize, dev_range, data, label, npair_type, 
+                       num_parallel_calls=tf.data.AUTOTUNE, prefetch=tf.data.AUTOTUNE, transform=None):
+        if transform is None:
+            data = as_float32(data)
+        get_npair_batch = self._init_sampling(dev_range, data, label, npair_type)
+
+        return create_tf_dataset(get_npair_batch, self.data, batchsize, 
+                                 num_parallel_calls, prefetch, transform)
+
+    def create_generator(self, batchsize, dev_range, data, label, npair_type):
+        # Cast once to float32 (no copy if the spectrograms already are).
+        get_npair_batch = self._init_sampling(dev_range, as_float32(data), label, npair_type)
+
         while True:
-            A = np.zeros((batchsize, data.shape[1], data.shape[2], data.shape[3]), dtype='float32')
-            P = np.zeros((batchsize, data.shape[1], data.shape[2], data.shape[3]), dtype='float32')
-            N = np.zeros((self.num_neg, batchsize, data.shape[1], data.shape[2], data.shape[3]), dtype='float32')
-
-            for i in range(batchsize):
-                if npair_type == 'samedev':
-                    a, p, n = self.get_npair_samedev()
-                elif npair_type == 'diffdev':
-                    a, p, n = self.get_npair_diffdev()
-                else: 
-                    raise Exception('Invalid npair type. Accepted values: [samedev, diffdev]') 
-
-                A[i, :, :, :] = a
-                P[i, :, :, :] = p
-                for neg_i in np.arange(self.num_neg):
-                    N[neg_i, i, :, :, :] = n[neg_i]
+            # One fancy-index gather for the whole batch: (num_neg + 2, batchsize, ...)
+            batch = self.data[get_npair_batch(batchsize)]
 
             yield_label = np.ones(batchsize) # dummy label, not actually used
-            yield_data = [A, P]
-            for neg_i in np.arange(self.num_neg):
-                N_i = np.squeeze(N[neg_i, :, :, :, :])
-                yield_data.append(N_i)
+            yield_data = list(batch)
             
             # In triple loss, yield_data is [A, P, N]
             # In N-loss, yield data is [A, P, N1, ..., NN]
@@ -315,12 +487,37 @@ class NPairNet():
 
         return anchor, positive, np.array(negatives)
 
+    # Batched version of get_npair_samedev: returns sample indexes of shape 
+    # (num_neg + 2, batchsize), i.e. [A, P, N1, ..., NN]
+    def get_npair_samedev_batch(self, batchsize):
+        num_dev = len(self.dev_range)
+
+        # Anchor devices, and one negative device per row that differs from the anchor
+        a = np.random.randint(num_dev, size=batchsize)
+        n = (a + np.random.randint(1, num_dev, size=batchsize)) % num_dev
+
+        dev_pos = np.stack([a, a] + [n] * self.num_neg)
+        return sample_label_index(self.label_index, dev_pos)
+
+    # Batched version of get_npair_diffdev: returns sample indexes of shape 
+    # (num_neg + 2, batchsize), i.e. [A, P, N1, ..., NN]
+    def get_npair_diffdev_batch(self, batchsize):
+        num_dev = len(self.dev_range)
+
+        # Anchor devices
+        a = np.random.randint(num_dev, size=batchsize)
+
+        # num_neg unique devices per row other than the anchor: a random permutation 
+        # of all devices where the anchor is pushed to the end
+        keys = np.random.random_sample((batchsize, num_dev))
+        keys[np.arange(batchsize), a] = np.inf
+        n = np.argsort(keys, axis=1)[:, :self.num_neg]
+
+        dev_pos = np.concatenate([a[None], a[None], n.T])
+        return sample_label_index(self.label_index, dev_pos)
+
     def call_sample(self, label_name):
         # TODO: consider an "except" feature to make sure randomizer doesn't pick up the same sample in one go
         # Choose an image from our training or test data with the given label.
-        num_sample = len(self.label)
-        idx = np.random.randint(num_sample)
-        while self.label[idx] != label_name:
-            # keep searching randomly!
-            idx = np.random.randint(num_sample) 
+        idx = sample_label_index(self.label_index, self.dev_pos[label_name])
         return self.data[idx]
\ No newline at end of file
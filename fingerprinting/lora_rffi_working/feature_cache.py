@@ -0,0 +1,168 @@
+import os
+import json
+import hashlib
+import threading
+import numpy as np
+
+class FeatureCache:
+    '''
+    On-disk cache of precomputed tensors (e.g. channel independent
+    spectrograms), stored as memory-mappable .npy files.
+
+    Entries are keyed by the content hash of the source dataset file plus
+    any parameters that affect the result (packet selection, STFT settings,
+    normalization, dtype...). The total size of the cache is bounded: the
+    least recently used entries are evicted first.
+    '''
+    _index_name = 'file_hashes.json'
+    _lock = threading.Lock()
+
+    def __init__(self, cache_dir, max_bytes = 20 * 2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def file_hash(self, file_path):
+        '''
+        Return the SHA-1 of a file's content. Hashes are remembered per
+        (path, size, mtime), so multi-GB datasets are only read once.
+        Directories (e.g. a SavedModel) hash all of the files they contain.
+        '''
+        if os.path.isdir(file_path):
+            sha1 = hashlib.sha1()
+            for root, dirs, files in sorted(os.walk(file_path)):
+                dirs.sort()
+                for file_name in sorted(files):
+                    path = os.path.join(root, file_name)
+                    sha1.update(os.path.relpath(path, file_path).encode())
+                    sha1.update(self.file_hash(path).encode())
+            return sha1.hexdigest()
+
+        stat = os.stat(file_path)
+        file_id = f'{os.path.abspath(file_path)}:{stat.st_size}:{stat.st_mtime_ns}'
+
+        index_path = os.path.join(self.cache_dir, self._index_name)
+        with self._lock:
+            index = {}
+            if os.path.exists(index_path):
+                with open(index_path, 'r') as f:
+                    index = json.load(f)
+            if file_id in index:
+                return index[file_id]
+
+        sha1 = hashlib.sha1()
+        with open(file_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(16 * 2**20), b''):
+                sha1.update(chunk)
+        digest = sha1.hexdigest()
+
+        with self._lock:
+            if os.path.exists(index_path):
+                with open(index_path, 'r') as f:
+                    index = json.load(f)
+            index[file_id] = digest
+            self._atomic_write_json(index_path, index)
+
+        return digest
+
+    def key(self, file_path, params):
+        '''Build a cache key from a source file and a dict of parameters.'''
+        params = {k: np.asarray(v).tolist() if isinstance(v, np.ndarray) else v for k, v in params.items()}
+        description = json.dumps({'file': self.file_hash(file_path), 'params': params}, sort_keys=True, default=str)
+        return hashlib.sha1(description.encode()).hexdigest()
+
+    def get(self, key):
+        '''Return the memory-mapped arrays stored under KEY, or None.'''
+        meta_path = self._meta_path(key)
+        if not os.path.exists(meta_path):
+            return None
+
+        with open(meta_path, 'r') as f:
+            names = json.load(f)['arrays']
+
+        # Mark as recently used (for LRU eviction).
+        os.utime(meta_path)
+
+        return tuple(np.load(self._array_path(key, name), mmap_mode='r') for name in names)
+
+    def put(self, key, *arrays):
+        '''
+        Store ARRAYS under KEY, then evict old entries above max_bytes.
+        An entry larger than max_bytes on its own is not stored (the other
+        entries are kept); returns whether the entry was stored.
+        '''
+        if sum(np.asarray(array).nbytes for array in arrays) > self.max_bytes:
+            return False
+
+        names = []
+        for i, array in enumerate(arrays):
+            name = f'arr{i}'
+            path = self._array_path(key, name)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.asarray(array))
+            os.replace(tmp_path, path)
+            names.append(name)
+
+        # The metadata file is written last: an entry exists only once it's complete.
+        self._atomic_write_json(self._meta_path(key), {'arrays': names})
+
+        self.evict(keep = key)
+        return True
+
+    def load(self, file_path, params, compute):
+        '''
+        Return the cached arrays for (FILE_PATH, PARAMS). On a miss,
+        COMPUTE() is called and its result (a tuple of arrays) is stored.
+        '''
+        key = self.key(file_path, params)
+        arrays = self.get(key)
+        if arrays is not None:
+            print(f'Loaded cached features for {file_path}')
+            return arrays
+
+        arrays = compute()
+        self.put(key, *arrays)
+        return arrays
+
+    def evict(self, keep = None):
+        '''
+        Drop least recently used entries until the cache fits max_bytes.
+        The entry under KEEP (e.g. the one just stored) is never dropped.
+        '''
+        with self._lock:
+            entries = []
+            total_bytes = 0
+            for file_name in os.listdir(self.cache_dir):
+                if not file_name.endswith('.meta.json'):
+                    continue
+                key = file_name[:-len('.meta.json')]
+                meta_path = self._meta_path(key)
+                with open(meta_path, 'r') as f:
+                    names = json.load(f)['arrays']
+                files = [meta_path] + [self._array_path(key, name) for name in names]
+                size = sum(os.path.getsize(f) for f in files)
+                total_bytes += size
+                if key != keep:
+                    entries.append((os.path.getmtime(meta_path), size, files))
+
+            for _, size, files in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                for f in files:
+                    os.remove(f)
+                total_bytes -= size
+
+    def _meta_path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.meta.json')
+
+    def _array_path(self, key, name):
+        return os.path.join(self.cache_dir, f'{key}.{name}.npy')
+
+    def _atomic_write_json(self, path, content):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(content, f)
+        os.replace(tmp_path, path)
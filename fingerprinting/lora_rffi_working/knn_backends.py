@@ -0,0 +1,333 @@
+import time
+import numpy as np
+from sklearn.metrics import roc_curve, accuracy_score
+from sklearn.neighbors import KNeighborsClassifier
+
+KNN_BACKENDS = ['exact', 'ivf', 'centroid']
+
+def make_knn_classifier(backend='exact', n_neighbors=20, **kwargs):
+    '''
+    Create the neighbour classifier used for enrollment matching.
+
+    INPUT:
+        BACKEND is 'exact' (scikit-learn brute-force/tree search), 'ivf'
+        (approximate, in-process inverted file index) or 'centroid' (match
+        against per-device centroids only).
+
+        N_NEIGHBORS is the number of neighbours used for voting / scoring.
+
+        KWARGS are forwarded to the backend (e.g. n_lists, n_probe for 'ivf',
+        n_centroids for 'centroid').
+
+    RETURN:
+        CLF exposes fit / predict / kneighbors like KNeighborsClassifier.
+    '''
+    if backend == 'exact':
+        return KNeighborsClassifier(n_neighbors=n_neighbors, metric='euclidean', **kwargs)
+    elif backend == 'ivf':
+        return IVFKNeighborsClassifier(n_neighbors=n_neighbors, **kwargs)
+    elif backend == 'centroid':
+        return CentroidClassifier(n_neighbors=n_neighbors, **kwargs)
+    else:
+        raise Exception(f'Invalid KNN backend. Accepted options: {KNN_BACKENDS}')
+
+def _squared_distances(x, y, y_sq_norms):
+    '''Squared euclidean distances between the rows of X and Y.'''
+    x_sq_norms = np.einsum('ij,ij->i', x, x)
+    dist = x_sq_norms[:, None] + y_sq_norms[None, :] - 2 * (x @ y.T)
+    return np.maximum(dist, 0)
+
+def _kmeans(x, n_clusters, n_iter, rng, chunk_size=65536):
+    '''Plain k-means (Lloyd iterations). Returns float32 centroids.'''
+    centroids = x[rng.choice(x.shape[0], n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        sq_norms = np.einsum('ij,ij->i', centroids, centroids)
+        assignment = np.empty(x.shape[0], dtype=int)
+        for start in range(0, x.shape[0], chunk_size):
+            dist = _squared_distances(x[start:start + chunk_size], centroids, sq_norms)
+            assignment[start:start + chunk_size] = np.argmin(dist, axis=1)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, x)
+        counts = np.bincount(assignment, minlength=n_clusters)
+
+        # Re-seed empty clusters with random vectors.
+        empty = counts == 0
+        sums[empty] = x[rng.choice(x.shape[0], np.count_nonzero(empty))]
+        counts[empty] = 1
+
+        centroids = (sums / counts[:, None]).astype(np.float32)
+
+    return centroids
+
+class IVFKNeighborsClassifier():
+    '''
+    Approximate K-NN classifier over float32 vectors, using an inverted file
+    (IVF) index: the enrollment vectors are split into N_LISTS k-means cells,
+    and each query is only compared with the vectors of its N_PROBE closest
+    cells. N_PROBE trades speed for recall (N_PROBE = N_LISTS is exact).
+    Queries whose probed cells hold fewer than N_NEIGHBORS vectors fall back
+    to the exact search.
+    '''
+    def __init__(self, n_neighbors=20, n_lists=None, n_probe=8, n_iter=20, seed=None, chunk_size=65536):
+        self.n_neighbors = n_neighbors
+        self.n_lists = n_lists
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.seed = seed
+        self.chunk_size = chunk_size
+
+    def _assign(self, x):
+        '''Index of the closest centroid for every row of X (chunked).'''
+        assignment = np.empty(x.shape[0], dtype=int)
+        for start in range(0, x.shape[0], self.chunk_size):
+            dist = _squared_distances(x[start:start + self.chunk_size], self.centroids_, self.centroid_sq_norms_)
+            assignment[start:start + self.chunk_size] = np.argmin(dist, axis=1)
+        return assignment
+
+    def _train_centroids(self, x, n_lists):
+        '''k-means cells of the coarse quantizer.'''
+        rng = np.random.default_rng(self.seed)
+        self.centroids_ = _kmeans(x, n_lists, self.n_iter, rng, self.chunk_size)
+        self.centroid_sq_norms_ = np.einsum('ij,ij->i', self.centroids_, self.centroids_)
+
+    def fit(self, X, y):
+        '''Build the index over the enrollment vectors X with labels Y.'''
+        x = np.ascontiguousarray(X, dtype=np.float32)
+        self.classes_, y_encoded = np.unique(np.ravel(y), return_inverse=True)
+
+        n_lists = self.n_lists or max(1, int(np.sqrt(x.shape[0])))
+        n_lists = min(n_lists, x.shape[0])
+        self._train_centroids(x, n_lists)
+
+        # Inverted lists: vectors sorted by cell, cell c is [offsets[c], offsets[c+1]).
+        assignment = self._assign(x)
+        order = np.argsort(assignment, kind='stable')
+        self.offsets_ = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))])
+        self.ids_ = order
+        self.vectors_ = x[order]
+        self.sq_norms_ = np.einsum('ij,ij->i', self.vectors_, self.vectors_)
+        self.y_ = y_encoded[order]
+
+        return self
+
+    def _search(self, X, k):
+        '''Squared distances and index positions of the K best candidates.'''
+        q = np.ascontiguousarray(X, dtype=np.float32)
+        n_query = q.shape[0]
+        n_lists = self.centroids_.shape[0]
+        n_probe = min(self.n_probe, n_lists)
+
+        # Cells to visit for every query.
+        centroid_dist = _squared_distances(q, self.centroids_, self.centroid_sq_norms_)
+        probes = np.argpartition(centroid_dist, n_probe - 1, axis=1)[:, :n_probe]
+
+        best_dist = np.full((n_query, k), np.inf, dtype=np.float32)
+        best_pos = np.full((n_query, k), -1, dtype=int)
+
+        # Visit cell by cell: all queries probing a cell are scored at once.
+        cell_of_probe = probes.ravel()
+        query_of_probe = np.repeat(np.arange(n_query), n_probe)
+        order = np.argsort(cell_of_probe, kind='stable')
+        cell_starts = np.searchsorted(cell_of_probe[order], np.arange(n_lists + 1))
+
+        for cell in range(n_lists):
+            queries = query_of_probe[order[cell_starts[cell]:cell_starts[cell + 1]]]
+            lo, hi = self.offsets_[cell], self.offsets_[cell + 1]
+            if len(queries) == 0 or hi == lo:
+                continue
+
+            dist = _squared_distances(q[queries], self.vectors_[lo:hi], self.sq_norms_[lo:hi])
+            pos = np.broadcast_to(np.arange(lo, hi), dist.shape)
+
+            # Merge with the current best k of these queries.
+            dist = np.concatenate([best_dist[queries], dist], axis=1)
+            pos = np.concatenate([best_pos[queries], pos], axis=1)
+            top = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            best_dist[queries] = np.take_along_axis(dist, top, axis=1)
+            best_pos[queries] = np.take_along_axis(pos, top, axis=1)
+
+        # Queries whose probed cells hold fewer than K vectors: exact search
+        # instead, so that every query gets K real neighbours.
+        short = np.flatnonzero(best_pos[:, -1] < 0) if k <= self.vectors_.shape[0] else []
+        for start in range(0, len(short), self.chunk_size):
+            queries = short[start:start + self.chunk_size]
+            dist = _squared_distances(q[queries], self.vectors_, self.sq_norms_)
+            top = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            best_dist[queries] = np.take_along_axis(dist, top, axis=1)
+            best_pos[queries] = top
+
+        # Sort neighbours by distance, as the exact search does.
+        order = np.argsort(best_dist, axis=1)
+        best_dist = np.take_along_axis(best_dist, order, axis=1)
+        best_pos = np.take_along_axis(best_pos, order, axis=1)
+
+        return best_dist, best_pos
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        '''
+        Find the (approximate) nearest enrollment vectors of every query.
+        Returns euclidean distances and indexes into the fitted X, like
+        KNeighborsClassifier.kneighbors.
+        '''
+        best_dist, best_pos = self._search(X, n_neighbors or self.n_neighbors)
+
+        indexes = np.where(best_pos >= 0, self.ids_[best_pos], -1)
+        if return_distance:
+            return np.sqrt(best_dist), indexes
+        return indexes
+
+    def predict(self, X):
+        '''Majority vote over the (approximate) K nearest neighbours.'''
+        _, pos = self._search(X, self.n_neighbors)
+
+        votes = np.zeros((pos.shape[0], len(self.classes_)), dtype=int)
+        rows = np.repeat(np.arange(pos.shape[0]), pos.shape[1])
+        valid = pos.ravel() >= 0
+        np.add.at(votes, (rows[valid], self.y_[pos.ravel()[valid]]), 1)
+
+        # Ties go to the smallest label, as in scikit-learn.
+        return self.classes_[np.argmax(votes, axis=1)]
+
+class CentroidClassifier():
+    '''
+    Fast-path classifier that collapses the enrollment embeddings of every
+    device into N_CENTROIDS centroids (k-means per device). Queries are
+    matched against centroids only, with a single matrix multiply, so the
+    per-query cost is O(devices) instead of O(enrollment packets).
+    '''
+    def __init__(self, n_neighbors=1, n_centroids=1, n_iter=20, seed=None):
+        self.n_neighbors = n_neighbors
+        self.n_centroids = n_centroids
+        self.n_iter = n_iter
+        self.seed = seed
+
+    def fit(self, X, y):
+        '''Compute the centroids of every device in X (labels Y).'''
+        x = np.ascontiguousarray(X, dtype=np.float32)
+        y = np.ravel(y)
+        rng = np.random.default_rng(self.seed)
+
+        centroids = []
+        centroid_labels = []
+        for dev in np.unique(y):
+            x_dev = x[y == dev]
+            if self.n_centroids == 1:
+                dev_centroids = x_dev.mean(axis=0, keepdims=True)
+            else:
+                dev_centroids = _kmeans(x_dev, min(self.n_centroids, x_dev.shape[0]), self.n_iter, rng)
+            centroids.append(dev_centroids)
+            centroid_labels.append(np.full(dev_centroids.shape[0], dev))
+
+        self.centroids_ = np.concatenate(centroids).astype(np.float32)
+        self.centroid_labels_ = np.concatenate(centroid_labels)
+        self.centroid_sq_norms_ = np.einsum('ij,ij->i', self.centroids_, self.centroids_)
+        self.classes_ = np.unique(y)
+
+        return self
+
+    def kneighbors(self, X, n_neighbors=None, return_distance=True):
+        '''Euclidean distances and indexes of the nearest centroids.'''
+        k = min(n_neighbors or self.n_neighbors, self.centroids_.shape[0])
+        dist = _squared_distances(np.asarray(X, dtype=np.float32), self.centroids_, self.centroid_sq_norms_)
+
+        indexes = np.argsort(dist, axis=1)[:, :k]
+        if return_distance:
+            return np.sqrt(np.take_along_axis(dist, indexes, axis=1)), indexes
+        return indexes
+
+    def predict(self, X):
+        '''Label of the nearest centroid.'''
+        dist = _squared_distances(np.asarray(X, dtype=np.float32), self.centroids_, self.centroid_sq_norms_)
+        return self.centroid_labels_[np.argmin(dist, axis=1)]
+
+    def detection_score(self, X):
+        '''Distance to the nearest centroid (the lower, the more likely legitimate).'''
+        dist = _squared_distances(np.asarray(X, dtype=np.float32), self.centroids_, self.centroid_sq_norms_)
+        return np.sqrt(dist.min(axis=1))
+
+def _compute_eer(detection_score, is_legitimate):
+    '''EER of a distance-based detection score (lower score = legitimate).'''
+    fpr, tpr, _ = roc_curve(is_legitimate, -detection_score, pos_label = 1)
+    fnr = 1 - tpr
+    min_index = np.argmin(np.abs(fpr - fnr))
+    return np.mean((fpr[min_index], fnr[min_index]))
+
+def compare_centroid_knn(feature_enrol, label_enrol, feature_test, label_test, is_legitimate=None,
+                         n_neighbors=20, n_centroids=(1, 2, 4, 8), seed=None):
+    '''
+    Report accuracy (and EER of rogue device detection, if IS_LEGITIMATE
+    marks legitimate vs rogue test packets) of the centroid fast path
+    against the full K-NN.
+
+    RETURN:
+        RESULTS is a list of dicts, one per classifier.
+    '''
+    if is_legitimate is None:
+        is_legitimate = np.ones(len(feature_test), dtype=bool)
+    is_legitimate = np.ravel(is_legitimate).astype(bool)
+    label_test = np.ravel(label_test)
+    with_eer = 0 < np.count_nonzero(is_legitimate) < len(is_legitimate)
+
+    knn = make_knn_classifier('exact', n_neighbors).fit(feature_enrol, np.ravel(label_enrol))
+    classifiers = [('knn', None, knn)]
+    for n in n_centroids:
+        classifiers.append(('centroid', n, make_knn_classifier('centroid', n_centroids=n, seed=seed).fit(feature_enrol, label_enrol)))
+
+    results = []
+    print('classifier  centroids  accuracy  eer       query_time[s]')
+    for name, n, clf in classifiers:
+        start = time.time()
+        pred_label = clf.predict(feature_test[is_legitimate])
+        if name == 'knn':
+            # Average distance to the nearest neighbours, as in rogue device detection.
+            detection_score = clf.kneighbors(feature_test)[0].mean(axis=1)
+        else:
+            detection_score = clf.detection_score(feature_test)
+        query_time = time.time() - start
+
+        acc = accuracy_score(label_test[is_legitimate], pred_label)
+        eer = _compute_eer(detection_score, is_legitimate) if with_eer else np.nan
+
+        results.append({'classifier': name, 'n_centroids': n, 'accuracy': acc, 'eer': eer, 'query_time': query_time})
+        print('%-11s %-10s %.4f    %.4f    %.4f' % (name, '-' if n is None else n, acc, eer, query_time))
+
+    return results
+
+def benchmark_recall(feature_enrol, label_enrol, feature_query, n_neighbors=20,
+                     n_lists=None, n_probes=(1, 2, 4, 8, 16, 32), seed=None):
+    '''
+    Compare the IVF backend against the exact search for a range of N_PROBE
+    values: recall@K of the neighbour sets, agreement of the predicted labels
+    and query time.
+
+    RETURN:
+        RESULTS is a list of dicts, one per N_PROBE value (plus the exact search).
+    '''
+    exact = make_knn_classifier('exact', n_neighbors).fit(feature_enrol, np.ravel(label_enrol))
+    start = time.time()
+    exact_idx = exact.kneighbors(feature_query, return_distance=False)
+    exact_pred = exact.predict(feature_query)
+    exact_time = time.time() - start
+
+    results = [{'backend': 'exact', 'n_probe': None, 'recall': 1.0, 'label_agreement': 1.0, 'query_time': exact_time}]
+    print('backend  n_probe  recall@%d  label_agreement  query_time[s]' % n_neighbors)
+    print('exact    -        1.0000     1.0000           %.4f' % exact_time)
+
+    ivf = make_knn_classifier('ivf', n_neighbors, n_lists=n_lists, seed=seed).fit(feature_enrol, label_enrol)
+    for n_probe in n_probes:
+        ivf.n_probe = n_probe
+        start = time.time()
+        ivf_idx = ivf.kneighbors(feature_query, return_distance=False)
+        ivf_pred = ivf.predict(feature_query)
+        ivf_time = time.time() - start
+
+        hits = [len(np.intersect1d(a, b)) for a, b in zip(exact_idx, ivf_idx)]
+        recall = np.sum(hits) / exact_idx.size
+        agreement = np.mean(ivf_pred == exact_pred)
+
+        results.append({'backend': 'ivf', 'n_probe': n_probe, 'recall': recall, 'label_agreement': agreement, 'query_time': ivf_time})
+        print('ivf      %-8d %.4f     %.4f           %.4f' % (n_probe, recall, agreement, ivf_time))
+
+    return results
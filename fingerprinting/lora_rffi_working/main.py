@@ -1,31 +1,49 @@
 import numpy as np
 import os
+import csv
+import glob
+from functools import lru_cache
 import matplotlib.pyplot as plt
 import seaborn as sns
 from sklearn.metrics import roc_curve, auc , confusion_matrix, accuracy_score
-from sklearn.neighbors import KNeighborsClassifier
 from sklearn.model_selection import train_test_split
 from keras.models import load_model
 from keras.callbacks import EarlyStopping, ReduceLROnPlateau
 from keras.optimizers import RMSprop
-from dataset_preparation import awgn, LoadDataset, ChannelIndSpectrogram
+from dataset_preparation import awgn, LoadDataset, LazyRFDataset, ChannelIndSpectrogram
 from deep_learning_models import TripletNet, identity_loss
+from feature_cache import FeatureCache
+from knn_backends import make_knn_classifier
+from prefetch_loader import PrefetchLoader
 
 TRAINING_NODES_COUNT = 30
 TESTING_NODES_COUNT = 10
 SAMPLES_COUNT_TRAIN = 400
 SAMPLES_COUNT_TEST = 100
+# IQ samples as complex64 and spectrograms as float32 end-to-end ('float64' for the legacy behaviour)
+PRECISION = 'float32'
+# Channel independent spectrogram settings (STFT window/overlap, output size)
+SPECTROGRAM_PARAMS = {'row': 50, 'col': 14, 'win_len': 50, 'overlap': 25}
+# Enrollment matching: 'exact' (scikit-learn), 'ivf' (approximate index, see knn_backends.benchmark_recall)
+# or 'centroid' (per-device centroids, see knn_backends.compare_centroid_knn)
+KNN_BACKEND = 'exact'
+KNN_PARAMS = {'n_neighbors': 20}
 
 def train_feature_extractor(
         file_path = './dataset/Train/dataset_training_aug.h5', 
         dev_range = np.arange(0,TRAINING_NODES_COUNT, dtype = int), 
         pkt_range = np.arange(0,SAMPLES_COUNT_TRAIN, dtype = int),
-        snr_range = np.arange(20,80)):
+        snr_range = np.arange(20,80),
+        seed = None,
+        use_tf_data = False,
+        mining = 'random',
+        use_prefetch = False):
     '''
     train_feature_extractor trains an RFF extractor using triplet loss.
     
     INPUT: 
-        FILE_PATH is the path of training dataset.
+        FILE_PATH is the path of training dataset, or a list of paths 
+        (e.g. several sessions) read lazily through LazyRFDataset.
         
         DEV_RANGE is the label range of LoRa devices to train the RFF extractor.
         
@@ -33,27 +51,84 @@ def train_feature_extractor(
         
         SNR_RANGE is the SNR range used in data augmentation. 
         
+        SEED makes the data augmentation reproducible across runs.
+        
+        USE_TF_DATA switches training to the tf.data pipeline: batches are 
+        assembled in parallel and prefetched, and AWGN + spectrogram 
+        conversion run per batch (fresh noise every step).
+        
+        MINING selects how triplets are formed: 'random' triplets through the 
+        triplet net, or 'batch_hard' online mining over P devices x K samples 
+        batches (one forward pass per batch).
+        
+        USE_PREFETCH streams training through PrefetchLoader: shuffled blocks 
+        of packets are read, augmented and converted in background threads 
+        while the model trains, and the batches are sampled within each block. 
+        Memory is bounded by the loader queue.
+        
     RETURN:
         FEATURE_EXTRACTOR is the RFF extractor which can extract features from
         channel-independent spectrograms.
     '''
     
-    LoadDatasetObj = LoadDataset()
-    
-    # Load preamble IQ samples and labels.
-    data, label = LoadDatasetObj.load_iq_samples(file_path, 
-                                                 dev_range, 
-                                                 pkt_range)
+    if mining not in ['random', 'batch_hard']:
+        raise Exception('Invalid mining type. Accepted options: [random, batch_hard]')
+    if mining == 'batch_hard' and use_tf_data:
+        raise Exception('Batch-hard mining is only available with the Python generators.')
+    if use_prefetch and (use_tf_data or isinstance(file_path, (list, tuple))):
+        raise Exception('The prefetch loader reads a single dataset file, without tf.data.')
+    
+    ChannelIndSpectrogramObj = ChannelIndSpectrogram(precision = PRECISION)
+    
+    if use_prefetch:
+        data = PrefetchLoader(file_path, 
+                              dev_range, 
+                              pkt_range, 
+                              precision = PRECISION, 
+                              transform = lambda batch, rng: awgn(batch, snr_range, seed = rng), 
+                              shuffle = True, 
+                              seed = seed)
+        label = data.label
+        datashape = (None,) + data.sample_shape
+        transform = None
+    elif isinstance(file_path, (list, tuple)):
+        # A multi-file corpus does not fit in memory: packets are read from 
+        # disk per batch, then augmented and converted on the fly.
+        rng = np.random.default_rng(seed)
+        def augment(batch):
+            return ChannelIndSpectrogramObj.channel_ind_spectrogram(awgn(batch, snr_range, seed = rng))
+        data = LazyRFDataset(file_path, 
+                             dev_range, 
+                             pkt_range, 
+                             precision = PRECISION, 
+                             transform = augment)
+        label = data.label
+        datashape = data.shape
+        transform = None
+    else:
+        LoadDatasetObj = LoadDataset(precision = PRECISION)
+        
+        # Load preamble IQ samples and labels.
+        data, label, _ = LoadDatasetObj.load_iq_samples(file_path, 
+                                                        dev_range, 
+                                                        pkt_range)
+        
+        if use_tf_data:
+            # Augmentation and spectrogram conversion happen per batch in the 
+            # tf.data pipeline, so keep the IQ samples as they are.
+            rng = np.random.default_rng(seed)
+            def transform(batch):
+                return ChannelIndSpectrogramObj.channel_ind_spectrogram(awgn(batch, snr_range, seed = rng))
+            datashape = (None,) + transform(data[:1].copy()).shape[1:]
+        else:
+            # Add additive Gaussian noise to the IQ samples.
+            data = awgn(data, snr_range, seed = seed)
+            
+            # Convert time-domain IQ samples to channel-independent spectrograms.
+            data = ChannelIndSpectrogramObj.channel_ind_spectrogram(data)
+            datashape = data.shape
     
     dev_range = np.array(list(set(label.flatten())))
-    
-    # Add additive Gaussian noise to the IQ samples.
-    data = awgn(data, snr_range)
-    
-    ChannelIndSpectrogramObj = ChannelIndSpectrogram()
-    
-    # Convert time-domain IQ samples to channel-independent spectrograms.
-    data = ChannelIndSpectrogramObj.channel_ind_spectrogram(data)
 
     # for i in [1, 2, 3, 4, 5, 6, 7, 8, 9]:
     #     print('Plotting')
@@ -65,14 +140,23 @@ def train_feature_extractor(
     margin = 0.1
     batch_size = 32
     patience = 15
+    # Batch-hard mining: P devices x K samples per batch (P * K == batch_size)
+    pk_devices = 8
+    pk_samples = batch_size // pk_devices
     
     TripletNetObj = TripletNet()
     
     # Create an RFF extractor.
-    feature_extractor = TripletNetObj.feature_extractor(data.shape)
-    
-    # Create the Triplet net using the RFF extractor.
-    triplet_net = TripletNetObj.create_triplet_net(feature_extractor, margin)
+    feature_extractor = TripletNetObj.feature_extractor(datashape)
+    
+    if mining == 'batch_hard':
+        # The RFF extractor is trained directly, with in-batch hard triplets.
+        triplet_net = TripletNetObj.create_batch_hard_net(feature_extractor, margin)
+        loss = TripletNetObj.batch_hard_triplet_loss
+    else:
+        # Create the Triplet net using the RFF extractor.
+        triplet_net = TripletNetObj.create_triplet_net(feature_extractor, margin, tough_coef = 1.0)
+        loss = identity_loss
 
     # Create callbacks during training. The training stops when validation loss 
     # does not decrease for 30 epochs.
@@ -89,39 +173,169 @@ def train_feature_extractor(
     callbacks = [early_stop, reduce_lr]
     
     # Split the dasetset into validation and training sets.
-    data_train, data_valid, label_train, label_valid = train_test_split(data, 
-                                                                        label, 
-                                                                        test_size=0.1, 
-                                                                        shuffle= True)
+    if isinstance(data, (LazyRFDataset, PrefetchLoader)):
+        data_train, data_valid = data.split(test_size = 0.1, seed = seed)
+        label_train, label_valid = data_train.label, data_valid.label
+    else:
+        data_train, data_valid, label_train, label_valid = train_test_split(data, 
+                                                                            label, 
+                                                                            test_size=0.1, 
+                                                                            shuffle= True)
     del data, label
     
-    # Create the trainining generator.
-    train_generator = TripletNetObj.create_generator(batch_size, 
-                                                     dev_range, 
-                                                     data_train, 
-                                                     label_train)
-    # Create the validation generator.
-    valid_generator = TripletNetObj.create_generator(batch_size, 
-                                                     dev_range, 
-                                                     data_valid, 
-                                                     label_valid)
+    if use_prefetch:
+        # Batches sampled within the prefetched blocks (one sampler per generator).
+        pk = pk_devices if mining == 'batch_hard' else None
+        train_generator = data_train.training_generator(TripletNet(), batch_size, dev_range, pk)
+        valid_generator = data_valid.training_generator(TripletNet(), batch_size, dev_range, pk)
+    elif mining == 'batch_hard':
+        # Create the P x K training and validation generators.
+        train_generator = TripletNetObj.create_pk_generator(pk_devices, 
+                                                            pk_samples, 
+                                                            dev_range, 
+                                                            data_train, 
+                                                            label_train)
+        valid_generator = TripletNetObj.create_pk_generator(pk_devices, 
+                                                            pk_samples, 
+                                                            dev_range, 
+                                                            data_valid, 
+                                                            label_valid)
+    elif use_tf_data:
+        # Create the training and validation tf.data pipelines.
+        train_generator = TripletNetObj.create_dataset(batch_size, 
+                                                       dev_range, 
+                                                       data_train, 
+                                                       label_train, 
+                                                       transform = transform)
+        valid_generator = TripletNetObj.create_dataset(batch_size, 
+                                                       dev_range, 
+                                                       data_valid, 
+                                                       label_valid, 
+                                                       transform = transform)
+    else:
+        # Create the trainining generator.
+        train_generator = TripletNetObj.create_generator(batch_size, 
+                                                         dev_range, 
+                                                         data_train, 
+                                                         label_train)
+        # Create the validation generator.
+        valid_generator = TripletNetObj.create_generator(batch_size, 
+                                                         dev_range, 
+                                                         data_valid, 
+                                                         label_valid)
     
     
     # Use the RMSprop optimizer for training.
     opt = RMSprop(learning_rate=1e-3)
-    triplet_net.compile(loss = identity_loss, optimizer = opt)
+    triplet_net.compile(loss = loss, optimizer = opt)
 
     # Start training.
     history = triplet_net.fit(train_generator,
-                              steps_per_epoch = data_train.shape[0]//batch_size,
+                              steps_per_epoch = len(data_train)//batch_size,
                               epochs = 1000,
                               validation_data = valid_generator,
-                              validation_steps = data_valid.shape[0]//batch_size,
+                              validation_steps = len(data_valid)//batch_size,
                               verbose=1, 
                               callbacks = callbacks)
     
     return feature_extractor
 
+@lru_cache(maxsize = 1)
+def load_feature_extractor(feature_extractor_name):
+    '''Load a saved RFF extractor (once per process).'''
+    return load_model(feature_extractor_name, compile=False)
+
+def spectrogram_cache_params(dev_range, pkt_range):
+    '''FeatureCache parameters of the spectrograms of a packet selection.'''
+    return {'features': 'channel_ind_spectrogram', 
+            'normalization': 'rms', 
+            'precision': PRECISION, 
+            'dev_range': dev_range, 
+            'pkt_range': pkt_range, 
+            **SPECTROGRAM_PARAMS}
+
+def load_spectrograms(file_path, dev_range, pkt_range, feature_cache = None):
+    '''
+    load_spectrograms loads IQ samples and labels from a dataset and converts 
+    them to channel independent spectrograms.
+    
+    INPUT:
+        FILE_PATH is the dataset path.
+        
+        DEV_RANGE, PKT_RANGE specify the loaded devices and packets.
+        
+        FEATURE_CACHE (optional FeatureCache) stores the spectrograms, so 
+        repeated evaluations skip the DSP.
+        
+    RETURN:
+        DATA is the channel independent spectrograms.
+        
+        LABEL is the true label of each packet.
+    '''
+    def compute():
+        # H5 reads and spectrogram conversions overlap (see PrefetchLoader).
+        data, label = PrefetchLoader(file_path, 
+                                     dev_range, 
+                                     pkt_range, 
+                                     precision = PRECISION, 
+                                     spectrogram_params = SPECTROGRAM_PARAMS).load()
+        print(f"Data shape: {data.shape}")
+        return data, label
+    
+    if feature_cache is None:
+        return compute()
+    
+    return feature_cache.load(file_path, spectrogram_cache_params(dev_range, pkt_range), compute)
+
+def load_embeddings(file_path, dev_range, pkt_range, feature_extractor_name, feature_cache = None):
+    '''
+    load_embeddings extracts RFFs from the channel independent spectrograms 
+    of a dataset.
+    
+    INPUT:
+        FILE_PATH is the dataset path.
+        
+        DEV_RANGE, PKT_RANGE specify the loaded devices and packets.
+        
+        FEATURE_EXTRACTOR_NAME is the path of the saved RFF extractor. It is 
+        only loaded if the embeddings are not cached.
+        
+        FEATURE_CACHE (optional FeatureCache) stores the embeddings per 
+        (model, dataset, packet selection).
+        
+    RETURN:
+        FEATURES is the extracted RFFs.
+        
+        LABEL is the true label of each packet.
+    '''
+    def compute():
+        # Spectrograms already cached for another model are reused.
+        spectrograms = None
+        if feature_cache is not None:
+            spectrograms = feature_cache.get(feature_cache.key(file_path, spectrogram_cache_params(dev_range, pkt_range)))
+        if spectrograms is not None:
+            data, label = spectrograms
+            return load_feature_extractor(feature_extractor_name).predict(data), np.asarray(label)
+        
+        # Stream the dataset: H5 reads, spectrograms and the model overlap.
+        loader = PrefetchLoader(file_path, 
+                                dev_range, 
+                                pkt_range, 
+                                precision = PRECISION, 
+                                spectrogram_params = SPECTROGRAM_PARAMS)
+        return loader.predict(load_feature_extractor(feature_extractor_name))
+    
+    if feature_cache is None:
+        return compute()
+    
+    params = {'features': 'embedding', 
+              'model': feature_cache.file_hash(feature_extractor_name), 
+              'precision': PRECISION, 
+              'dev_range': dev_range, 
+              'pkt_range': pkt_range, 
+              **SPECTROGRAM_PARAMS}
+    return feature_cache.load(file_path, params, compute)
+
 def test_classification(
         file_path_enrol,
         file_path_clf,
@@ -129,7 +343,8 @@ def test_classification(
         dev_range_enrol = np.arange(0,TESTING_NODES_COUNT, dtype = int),
         pkt_range_enrol = np.arange(0,SAMPLES_COUNT_TEST, dtype = int),
         dev_range_clf = np.arange(0,TESTING_NODES_COUNT, dtype = int),
-        pkt_range_clf = np.arange(0,SAMPLES_COUNT_TEST, dtype = int)):
+        pkt_range_clf = np.arange(0,SAMPLES_COUNT_TEST, dtype = int),
+        feature_cache = None):
     '''
     test_classification performs a classification task and returns the 
     classification accuracy.
@@ -149,6 +364,10 @@ def test_classification(
         DEV_RANGE_CLF is the label range of LoRa devices during classification.
         
         PKT_RANGE_CLF is the range of packets from each LoRa device during classification.
+        
+        FEATURE_CACHE (optional FeatureCache) stores the channel independent 
+        spectrograms and the RFF embeddings (per model) of each dataset, so 
+        repeated evaluations skip the DSP and the feature extraction.
 
     RETURN:
         PRED_LABEL is the list of predicted labels.
@@ -158,23 +377,6 @@ def test_classification(
         ACC is the overall classification accuracy.
     '''
     
-    # Load the saved RFF extractor.
-    feature_extractor = load_model(feature_extractor_name, compile=False)
-    
-    LoadDatasetObj = LoadDataset()
-    
-    # Load the enrollment dataset. (IQ samples and labels)
-    data_enrol, label_enrol = LoadDatasetObj.load_iq_samples(file_path_enrol, 
-                                                             dev_range_enrol, 
-                                                             pkt_range_enrol)
-    
-    print(f"Data enrol shape: {data_enrol.shape}")
-    
-    ChannelIndSpectrogramObj = ChannelIndSpectrogram()
-    
-    # Convert IQ samples to channel independent spectrograms. (enrollment data)
-    data_enrol = ChannelIndSpectrogramObj.channel_ind_spectrogram(data_enrol)
-    
     # Visualize channel independent spectrogram
     # plt.figure()
     # sns.heatmap(data_enrol[0,:,:,0],xticklabels=[], yticklabels=[], cmap='Blues', cbar=False)
@@ -182,30 +384,26 @@ def test_classification(
     # plt.show()
     # plt.savefig('channel_ind_spectrogram.pdf')
     
-    # Extract RFFs from channel independent spectrograms.
+    # Extract RFFs of the enrollment dataset.
     print("Generating enrollment fingerprints...")
-    feature_enrol = feature_extractor.predict(data_enrol)
-    del data_enrol
+    feature_enrol, label_enrol = load_embeddings(file_path_enrol, 
+                                                 dev_range_enrol, 
+                                                 pkt_range_enrol, 
+                                                 feature_extractor_name, 
+                                                 feature_cache)
     
     # Create a K-NN classifier using the RFFs extracted from the enrollment dataset.
-    knnclf=KNeighborsClassifier(n_neighbors=20,metric='euclidean')
+    knnclf=make_knn_classifier(KNN_BACKEND, **KNN_PARAMS)
     knnclf.fit(feature_enrol, np.ravel(label_enrol))
     
     
-    # Load the classification dataset. (IQ samples and labels)
-    data_clf, true_label = LoadDatasetObj.load_iq_samples(file_path_clf, 
-                                                         dev_range_clf, 
-                                                         pkt_range_clf)
-    
-    print(f"Data identify shape: {data_clf.shape}")
-    
-    # Convert IQ samples to channel independent spectrograms. (classification data)
-    data_clf = ChannelIndSpectrogramObj.channel_ind_spectrogram(data_clf)
-
-    # Extract RFFs from channel independent spectrograms.
+    # Extract RFFs of the classification dataset.
     print("Generating fingerprints for comparison")
-    feature_clf = feature_extractor.predict(data_clf)
-    del data_clf
+    feature_clf, true_label = load_embeddings(file_path_clf, 
+                                              dev_range_clf, 
+                                              pkt_range_clf, 
+                                              feature_extractor_name, 
+                                              feature_cache)
     
     # Make prediction using the K-NN classifier.
     pred_label = knnclf.predict(feature_clf)
@@ -216,13 +414,89 @@ def test_classification(
     
     return pred_label, true_label, acc
 
+def evaluate_epochs(
+        file_path_enrol,
+        file_paths_clf,
+        feature_extractor_name,
+        output_path = 'epoch_accuracy.csv',
+        file_pattern = '*epoch_*.h5',
+        dev_range_enrol = np.arange(0,TESTING_NODES_COUNT, dtype = int),
+        pkt_range_enrol = np.arange(0,SAMPLES_COUNT_TEST, dtype = int),
+        dev_range_clf = np.arange(0,TESTING_NODES_COUNT, dtype = int),
+        pkt_range_clf = np.arange(0,SAMPLES_COUNT_TEST, dtype = int),
+        feature_cache = None):
+    '''
+    evaluate_epochs runs the classification task for many identification 
+    epochs in one process: the RFF extractor, the enrollment features and 
+    the K-NN classifier are prepared once, then each epoch file is streamed 
+    through them.
+    
+    INPUT: 
+        FILE_PATH_ENROL is the path of enrollment dataset.
+        
+        FILE_PATHS_CLF is a list of classification (epoch) datasets, or a 
+        directory to search with FILE_PATTERN.
+        
+        FEATURE_EXTRACTOR_NAME is the name of RFF extractor.
+        
+        OUTPUT_PATH is the CSV file the accuracy-per-epoch table is written to.
+        
+        DEV_RANGE_*, PKT_RANGE_* are the device and packet ranges used during 
+        enrollment and classification.
+        
+        FEATURE_CACHE (optional FeatureCache) stores spectrograms and embeddings.
+        
+    RETURN:
+        RESULTS is a list of (epoch file, number of packets, accuracy).
+    '''
+    if isinstance(file_paths_clf, str) and os.path.isdir(file_paths_clf):
+        file_paths_clf = sorted(glob.glob(os.path.join(file_paths_clf, file_pattern)))
+    print(f"Evaluating {len(file_paths_clf)} epochs.")
+    
+    # Extract RFFs of the enrollment dataset and build the K-NN classifier (once).
+    print("Generating enrollment fingerprints...")
+    feature_enrol, label_enrol = load_embeddings(file_path_enrol, 
+                                                 dev_range_enrol, 
+                                                 pkt_range_enrol, 
+                                                 feature_extractor_name, 
+                                                 feature_cache)
+    knnclf=make_knn_classifier(KNN_BACKEND, **KNN_PARAMS)
+    knnclf.fit(feature_enrol, np.ravel(label_enrol))
+    
+    results = []
+    with open(output_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['epoch', 'packets', 'accuracy'])
+        
+        for file_path_clf in file_paths_clf:
+            # Extract RFFs of the epoch and classify them.
+            feature_clf, true_label = load_embeddings(file_path_clf, 
+                                                      dev_range_clf, 
+                                                      pkt_range_clf, 
+                                                      feature_extractor_name, 
+                                                      feature_cache)
+            pred_label = knnclf.predict(feature_clf)
+            acc = accuracy_score(np.ravel(true_label), pred_label)
+            
+            epoch_name = os.path.basename(file_path_clf)
+            print('%s: accuracy = %.4f' % (epoch_name, acc))
+            results.append((epoch_name, len(pred_label), acc))
+            
+            # Write every row as it comes, so a long sweep can be followed live.
+            writer.writerow([epoch_name, len(pred_label), '%.4f' % acc])
+            f.flush()
+    
+    return results
+
 def request_mode():
     while True:
-        mode = input("Which mode should we run? [train | classify]")
+        mode = input("Which mode should we run? [train | classify | evaluate]")
         if mode == 'train':
             return 'Train'
         elif mode == 'classify':
             return 'Classification'
+        elif mode == 'evaluate':
+            return 'Evaluation'
         else: print("Invalid command.")
 
 if __name__ == '__main__':
@@ -249,13 +523,16 @@ if __name__ == '__main__':
     dataset_train = os.path.join(root_path, 'training_2024-07-13_06-53-20', 'node1-1_non_eq_train.h5')
     dataset_enrol = os.path.join(root_path, 'epoch_2024-07-13_07-40-21', 'node1-1_non_eq_test.h5')
     dataset_identify = os.path.join(root_path, 'epoch_2024-07-13_07-52-31', 'node1-1_non_eq_test.h5')
+    dataset_epochs = sorted(glob.glob(os.path.join(root_path, 'epoch_*', 'node1-1_non_eq_test.h5')))
     model_path = os.path.join(root_path, 'my_models')
+    cache_path = os.path.join(root_path, 'feature_cache')
 
     # Dataset: Orbit v2 (automated capture)
     # root_path = '/home/smazokha2016/Desktop/mobintel-orbit-dataset_h5'
     # dataset_train = '/node1-1_training_2024-07-21_14-49-09.h5'
     # dataset_enrol = '/node1-1_epoch_2024-07-21_16-02-04.h5'
     # dataset_identify = '/node1-1_epoch_2024-07-21_16-26-15.h5'
+    # dataset_epochs = root_path # all node*_epoch_*.h5 files of the directory
     # # dataset_identify = '/node1-1_epoch_2024-07-21_20-20-50.h5'
     # model_path = '/orbit_models'
 
@@ -281,7 +558,8 @@ if __name__ == '__main__':
         # Perform the classification task.
         pred_label, true_label, acc = test_classification(file_path_enrol = dataset_enrol,
                                                           file_path_clf = dataset_identify,
-                                                          feature_extractor_name = model_path)
+                                                          feature_extractor_name = model_path,
+                                                          feature_cache = FeatureCache(cache_path))
         
         # Plot the confusion matrix.
         conf_mat = confusion_matrix(true_label, pred_label, normalize='true')
@@ -295,4 +573,11 @@ if __name__ == '__main__':
         #             yticklabels=classes)
         # plt.xlabel('Predicted label', fontsize = 20)
         # plt.ylabel('True label', fontsize = 20)
-        # plt.show()
\ No newline at end of file
+        # plt.show()
+    elif run_for == 'Evaluation':
+        # Evaluate the enrollment set against every epoch of the time-drift study.
+        results = evaluate_epochs(file_path_enrol = dataset_enrol,
+                                  file_paths_clf = dataset_epochs,
+                                  feature_extractor_name = model_path,
+                                  output_path = os.path.join(root_path, 'epoch_accuracy.csv'),
+                                  feature_cache = FeatureCache(cache_path))
\ No newline at end of file
@@ -0,0 +1,225 @@
+import copy
+import queue
+import threading
+import concurrent.futures
+import numpy as np
+import h5py
+
+from dataset_preparation import LoadDataset, ChannelIndSpectrogram, read_rows
+
+class PrefetchLoader():
+    '''
+    Producer/consumer loader of channel independent spectrograms.
+
+    One reader thread reads blocks of rows from the HDF5 dataset, a pool of
+    workers converts them with ChannelIndSpectrogram, and the converted
+    blocks are handed over in order through a bounded queue. Disk reads, DSP
+    and the model (predict / fit) run at the same time, and memory use is
+    capped by the queue size instead of the dataset size.
+    '''
+    def __init__(self, file_path, dev_range=None, pkt_range=None, block_size=1024,
+                 num_workers=4, queue_size=8, precision='float64',
+                 spectrogram_params=None, transform=None, shuffle=False, seed=None):
+        '''
+        INPUT:
+            FILE_PATH is the dataset path.
+
+            DEV_RANGE, PKT_RANGE select the devices and packets (see
+            LoadDataset.load_iq_samples).
+
+            BLOCK_SIZE is the number of packets read and converted at once.
+
+            NUM_WORKERS is the number of spectrogram conversion threads.
+
+            QUEUE_SIZE is the maximum number of blocks waiting to be consumed.
+
+            PRECISION is the dtype policy of the IQ samples and spectrograms.
+
+            SPECTROGRAM_PARAMS are passed to channel_ind_spectrogram.
+
+            TRANSFORM (optional) is applied to the IQ samples of every block
+            before the conversion, e.g. AWGN when feeding fit. It is called
+            as TRANSFORM(data, rng), with a np.random.Generator of its own per
+            block, drawn in read order: random transforms are reproducible
+            with SEED whatever the order the workers run in.
+
+            SHUFFLE reads the packets in a new random order on every pass,
+            so that blocks mix devices.
+
+            SEED makes the shuffling and the transform reproducible.
+        '''
+        self.file_path = file_path
+        self.block_size = block_size
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.spectrogram_params = spectrogram_params or {}
+        self.transform = transform
+        self.shuffle = shuffle
+        self._rng = np.random.default_rng(seed)
+        self._loader = LoadDataset(precision = precision)
+        self._spectrogram = ChannelIndSpectrogram(precision = precision)
+
+        # Only the labels are read upfront, to select the rows.
+        with h5py.File(file_path, 'r') as f:
+            label = f[self._loader.labelset_name][:].astype(int).reshape(-1, 1)
+            if dev_range is None and pkt_range is None:
+                self.rows = np.arange(len(label))
+            else:
+                self.rows = self._loader._select_rows(f, label, dev_range, pkt_range)
+        self.label = label[self.rows]
+
+    @property
+    def sample_shape(self):
+        '''Shape of the spectrogram of one packet.'''
+        with h5py.File(self.file_path, 'r') as f:
+            data = read_rows(f[self._loader.dataset_name], self.rows[:1], self._loader.real_dtype)
+        data = self._loader._convert_to_complex(data)
+        return self._spectrogram.channel_ind_spectrogram(data, **self.spectrogram_params).shape[1:]
+
+    @property
+    def num_blocks(self):
+        return -(-len(self.rows) // self.block_size)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        '''Yield (spectrograms, labels) blocks, in dataset order.'''
+        blocks = queue.Queue(maxsize = self.queue_size)
+        stop = threading.Event()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers = self.num_workers) as pool:
+            reader = threading.Thread(target = self._read_blocks,
+                                      args = (pool, blocks, stop),
+                                      daemon = True)
+            reader.start()
+            try:
+                while True:
+                    item = blocks.get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    future, label = item
+                    yield future.result(), label
+            finally:
+                # Also reached when the consumer stops early.
+                stop.set()
+                reader.join()
+
+    def generator(self, repeat=True):
+        '''(spectrograms, labels) blocks for fit, over and over if REPEAT.'''
+        while True:
+            yield from self
+            if not repeat:
+                return
+
+    def split(self, test_size=0.1, seed=None):
+        '''Random (train, test) split of the packets, as two loaders.'''
+        order = np.random.default_rng(seed).permutation(len(self.rows))
+        num_test = int(np.ceil(test_size * len(self.rows)))
+        return self._subset(np.sort(order[num_test:])), self._subset(np.sort(order[:num_test]))
+
+    def load(self):
+        '''
+        Convert the whole selection (e.g. to fill a FeatureCache).
+
+        RETURN:
+            DATA is the channel independent spectrograms.
+
+            LABEL is the true label of every packet.
+        '''
+        blocks = list(self)
+        if not blocks:
+            return np.zeros((0,) + self.sample_shape), self.label
+        return np.concatenate([data for data, _ in blocks]), np.concatenate([label for _, label in blocks])
+
+    def training_generator(self, triplet_net, batch_size, dev_range, pk_devices=None):
+        '''
+        Endless training batches for fit, sampled within every prefetched
+        block (create with SHUFFLE, so that blocks mix devices): about one
+        batch per BATCH_SIZE packets of the block.
+
+        INPUT:
+            TRIPLET_NET is the TripletNet whose generator format is used:
+            ([anchor, positive, negative], dummy label) as create_generator,
+            or (samples, device positions) as create_pk_generator if
+            PK_DEVICES (P devices x BATCH_SIZE // P samples) is given.
+
+            DEV_RANGE is the device labels used for training; blocks with
+            less than two of them are skipped.
+        '''
+        while True:
+            for data, label in self:
+                devices = np.intersect1d(np.ravel(label), dev_range)
+                if len(devices) < 2:
+                    continue
+                keep = np.isin(np.ravel(label), devices)
+                data, label = data[keep], label[keep]
+
+                if pk_devices is None:
+                    batches = triplet_net.create_generator(batch_size, devices, data, label)
+                else:
+                    batches = triplet_net.create_pk_generator(pk_devices, batch_size // pk_devices, devices, data, label)
+                for _ in range(max(1, len(label) // batch_size)):
+                    yield next(batches)
+
+    def predict(self, model):
+        '''
+        Run MODEL on every block as soon as it is converted.
+
+        RETURN:
+            OUTPUT is the model output of every packet.
+
+            LABEL is the true label of every packet.
+        '''
+        output, label = [], []
+        for data, block_label in self:
+            output.append(model.predict(data, verbose = 0))
+            label.append(block_label)
+        return np.concatenate(output), np.concatenate(label)
+
+    def _subset(self, index):
+        subset = copy.copy(self)
+        subset.rows = self.rows[index]
+        subset.label = self.label[index]
+        subset._rng = np.random.default_rng(self._rng.integers(2**32))
+        return subset
+
+    def _convert(self, data, rng):
+        '''Worker: interleaved rows -> (transformed) IQ samples -> spectrograms.'''
+        data = self._loader._convert_to_complex(data)
+        if self.transform is not None:
+            data = self.transform(data, rng)
+        return self._spectrogram.channel_ind_spectrogram(data, **self.spectrogram_params)
+
+    def _put(self, blocks, item, stop):
+        '''Put ITEM in the queue, unless the consumer stopped.'''
+        while not stop.is_set():
+            try:
+                blocks.put(item, timeout = 0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _read_blocks(self, pool, blocks, stop):
+        '''Reader thread: read row blocks in order and submit them to the workers.'''
+        try:
+            with h5py.File(self.file_path, 'r') as f:
+                dataset = f[self._loader.dataset_name]
+                order = self._rng.permutation(len(self.rows)) if self.shuffle else np.arange(len(self.rows))
+                for start in range(0, len(self.rows), self.block_size):
+                    block = order[start:start + self.block_size]
+                    data = read_rows(dataset, self.rows[block], self._loader.real_dtype)
+                    # Seeded here rather than in the workers, which run in any order
+                    rng = np.random.default_rng(self._rng.integers(2**32))
+                    future = pool.submit(self._convert, data, rng)
+                    if not self._put(blocks, (future, self.label[block]), stop):
+                        return
+        except Exception as e:
+            self._put(blocks, e, stop)
+            return
+
+        # End of the dataset
+        self._put(blocks, None, stop)
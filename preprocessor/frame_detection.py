@@ -0,0 +1,447 @@
+import zlib
+import numpy as np
+from scipy import signal
+from iq_capture import IQCapture
+
+# NumPy 802.11a/g (non-HT, CBW20) receiver: a replacement for find_tx_frames.m and the
+# MATLAB WaveformAnalyzer, so that frame detection runs in plain Python processes.
+#
+# Processing chain for each frame:
+# 1. L-STF: packet detection from the 16-sample autocorrelation (Schmidl-Cox metric),
+#    block by block over the whole capture at its own sample rate, and coarse CFO
+#    estimation; only the samples around each detected frame are resampled to 20 MHz
+# 2. L-LTF: fine timing (cross-correlation with the known long training symbol), fine
+#    CFO and channel estimation
+# 3. L-SIG: rate & length decoding (BPSK, rate 1/2)
+# 4. DATA: only the first OFDM symbols are decoded to read the MAC header transmitter
+#    address (Address 2); matching frames are then fully decoded to check their FCS
+
+BASEBAND_RATE = 20e6
+FFT_LEN = 64
+STF_PERIOD = 16
+STF_LEN = 160
+LTF_LEN = 160
+SIG_LEN = 80
+SYMBOL_LEN = 80
+CP_LEN = 16
+PREAMBLE_SIG_LEN = STF_LEN + LTF_LEN + SIG_LEN
+
+# Sampling advance into the cyclic prefix (robustness to timing errors)
+TIMING_BACKOFF = 4
+
+# L-STF autocorrelation window, and the number of consecutive samples the
+# metric must stay above threshold for a detection (at 20 MHz)
+DETECTION_WINDOW = 64
+DETECTION_MIN_RUN = 48
+# Capture samples processed at once by the detector
+DETECTION_BLOCK_SIZE = 2**20
+
+# Capture samples kept before a detection, and after the resampled extent of a frame
+SEGMENT_MARGIN = 128
+
+# L-LTF subcarriers -26..26
+LTF_FREQ = np.array([1, 1, -1, -1, 1, 1, -1, 1, -1, 1, 1, 1, 1, 1, 1, -1, -1, 1, 1, -1, 1, -1, 1, 1, 1, 1, 0,
+                     1, -1, -1, 1, 1, -1, 1, -1, 1, -1, -1, -1, -1, -1, 1, 1, -1, -1, 1, -1, 1, -1, 1, 1, 1, 1])
+SUBCARRIERS = np.arange(-26, 27)
+PILOT_SUBCARRIERS = np.array([-21, -7, 7, 21])
+PILOT_VALUES = np.array([1, 1, 1, -1])
+DATA_SUBCARRIERS = np.array([k for k in SUBCARRIERS if k != 0 and k not in PILOT_SUBCARRIERS])
+
+# L-SIG RATE bits (R1..R4) -> (Mbps, coded bits per subcarrier, coding rate, data bits per symbol)
+RATES = {
+    (1, 1, 0, 1): (6, 1, (1, 2), 24),
+    (1, 1, 1, 1): (9, 1, (3, 4), 36),
+    (0, 1, 0, 1): (12, 2, (1, 2), 48),
+    (0, 1, 1, 1): (18, 2, (3, 4), 72),
+    (1, 0, 0, 1): (24, 4, (1, 2), 96),
+    (1, 0, 1, 1): (36, 4, (3, 4), 144),
+    (0, 0, 0, 1): (48, 6, (2, 3), 192),
+    (0, 0, 1, 1): (54, 6, (3, 4), 216),
+}
+
+# PSDU bits needed to read the transmitter address: SERVICE (16) + Frame Control,
+# Duration, Address 1 and Address 2 (16 bytes), plus a Viterbi traceback margin
+HEADER_BITS = 16 + 16 * 8
+TRACEBACK_BITS = 48
+MAC_TA_BYTES = slice(10, 16)
+
+# Shortest MPDU carrying a transmitter address (header + FCS)
+MIN_MPDU_LEN = 20
+
+def _scrambler_sequence(initial_bits, length):
+    # Sequence of the x^7 + x^4 + 1 scrambler, given its first 7 output bits
+    seq = np.zeros(max(length, 7), dtype=np.uint8)
+    seq[:7] = initial_bits
+    for k in range(7, length):
+        seq[k] = seq[k - 7] ^ seq[k - 4]
+    return seq[:length]
+
+def _pilot_polarity():
+    # Pilot polarity p_0..p_126: the scrambler sequence for the all-ones initial
+    # state, whose first 7 output bits are 0, 0, 0, 0, 1, 1, 1
+    return 1 - 2 * _scrambler_sequence([0, 0, 0, 0, 1, 1, 1], 127).astype(int)
+
+PILOT_POLARITY = _pilot_polarity()
+
+def _ltf_symbol():
+    # Time-domain long training symbol (64 samples)
+    spectrum = np.zeros(FFT_LEN, dtype=complex)
+    spectrum[SUBCARRIERS % FFT_LEN] = LTF_FREQ
+    return np.fft.ifft(spectrum)
+
+LTF_SYMBOL = _ltf_symbol()
+
+def _deinterleaver(num_cbps, num_bpsc):
+    # Position of every coded bit k in the interleaved symbol (IEEE 802.11, 17.3.5.7)
+    s = max(num_bpsc // 2, 1)
+    k = np.arange(num_cbps)
+    i = (num_cbps // 16) * (k % 16) + k // 16
+    j = s * (i // s) + (i + num_cbps - (16 * i) // num_cbps) % s
+    return j
+
+# Convolutional code (K = 7, g0 = 133, g1 = 171): for every next state, its two
+# predecessors and the code bits (2 * a + b) of both transitions
+def _trellis():
+    g0, g1 = 0o133, 0o171
+    parity = lambda x: bin(x).count('1') % 2
+    next_states = np.arange(64)
+    bit = next_states >> 5
+    prev = np.stack([((next_states & 31) << 1) | x for x in (0, 1)], axis=1)
+    window = (bit[:, None] << 6) | prev
+    code = np.vectorize(lambda w: 2 * parity(w & g0) + parity(w & g1))(window)
+    return prev, code, bit
+
+TRELLIS_PREV, TRELLIS_CODE, TRELLIS_BIT = _trellis()
+
+# Puncturing patterns (1 = transmitted) over the A0 B0 A1 B1 ... sequence
+PUNCTURING = {
+    (1, 2): np.array([1, 1], dtype=bool),
+    (2, 3): np.array([1, 1, 1, 0], dtype=bool),
+    (3, 4): np.array([1, 1, 1, 0, 0, 1], dtype=bool),
+}
+
+def viterbi_decode(llr, coding_rate, num_bits):
+    # Soft-decision Viterbi decoding of NUM_BITS data bits from the coded bits LLRs
+    # (positive = bit 1). Punctured positions are re-inserted as erasures.
+    pattern = PUNCTURING[coding_rate]
+    num_coded = 2 * num_bits
+    mother = np.zeros(int(np.ceil(num_coded / len(pattern))) * len(pattern))
+    positions = np.flatnonzero(np.tile(pattern, len(mother) // len(pattern)))
+    count = min(len(llr), len(positions))
+    mother[positions[:count]] = llr[:count]
+    mother = mother[:num_coded].reshape(-1, 2)
+
+    metric = np.full(64, -np.inf)
+    metric[0] = 0.0
+    decisions = np.empty((num_bits, 64), dtype=np.uint8)
+    for t in range(num_bits):
+        la, lb = mother[t]
+        branch = np.array([-la - lb, -la + lb, la - lb, la + lb])
+        candidates = metric[TRELLIS_PREV] + branch[TRELLIS_CODE]
+        choice = candidates[:, 1] > candidates[:, 0]
+        decisions[t] = choice
+        metric = np.where(choice, candidates[:, 1], candidates[:, 0])
+
+    # Traceback from the best final state
+    bits = np.empty(num_bits, dtype=np.uint8)
+    state = int(np.argmax(metric))
+    for t in range(num_bits - 1, -1, -1):
+        bits[t] = TRELLIS_BIT[state]
+        state = TRELLIS_PREV[state, decisions[t, state]]
+    return bits
+
+def demap(symbols, num_bpsc):
+    # Soft demapping of Gray-coded BPSK/QPSK/16-QAM/64-QAM symbols to bit LLRs (positive = 1),
+    # in transmission order
+    if num_bpsc == 1:
+        return symbols.real[:, None].ravel()
+
+    scale = {2: np.sqrt(2), 4: np.sqrt(10), 6: np.sqrt(42)}[num_bpsc]
+    llr = []
+    for axis in (symbols.real * scale, symbols.imag * scale):
+        if num_bpsc == 2:
+            llr.append([axis])
+        elif num_bpsc == 4:
+            llr.append([axis, 2 - np.abs(axis)])
+        else:
+            llr.append([axis, 4 - np.abs(axis), 2 - np.abs(np.abs(axis) - 4)])
+    # Bits of the I axis first, then the Q axis
+    return np.stack(llr[0] + llr[1], axis=1).ravel()
+
+# Block-wise L-STF detector over a whole capture. The 16-sample-lag (at 20 MHz)
+# autocorrelation and the energy are sliding sums computed with cumulative sums over
+# float32 blocks, and consecutive blocks overlap by the lag + window: memory stays
+# bounded by the block size whatever the capture length. The sums are accumulated in
+# double precision: in float32, the difference of two large cumulative sums is mostly
+# rounding error in the quiet gaps that follow strong frames.
+class SchmidlCoxDetector:
+    def __init__(self, samp_rate=BASEBAND_RATE, threshold=0.5, block_size=DETECTION_BLOCK_SIZE):
+        osf = samp_rate / BASEBAND_RATE
+        self.lag = int(round(STF_PERIOD * osf))
+        self.window = int(round(DETECTION_WINDOW * osf))
+        self.min_run = int(round(DETECTION_MIN_RUN * osf))
+        self.threshold = threshold
+        self.block_size = block_size
+
+    # Normalized autocorrelation and windowed energy of the block positions whose
+    # windows lie in BLOCK (len(BLOCK) - lag - window + 1 positions)
+    def metric(self, block):
+        block = np.asarray(block, dtype=np.complex64)
+        delayed = block[self.lag:]
+        product = block[:-self.lag] * np.conj(delayed)
+        energy = delayed.real ** 2 + delayed.imag ** 2
+
+        corr_sum = np.cumsum(product, dtype=np.complex128)
+        energy_sum = np.cumsum(energy, dtype=np.float64)
+        corr = corr_sum[self.window - 1:].copy()
+        corr[1:] -= corr_sum[:-self.window]
+        energy = energy_sum[self.window - 1:].copy()
+        energy[1:] -= energy_sum[:-self.window]
+
+        # Windows with no signal at all (e.g. zero padding) are left at 0
+        floor = 1e-9 * energy_sum[-1] / len(energy_sum) * self.window if len(energy_sum) else 0
+        metric = np.zeros(len(energy), dtype=np.float32)
+        np.divide(np.abs(corr), energy, out=metric, where=energy > floor)
+        energy = energy.astype(np.float32)
+        return metric, energy
+
+    # Yield (start offset, power) of every detected packet, in capture samples: the start
+    # of each run where the metric stays above threshold, and the mean sample power over it
+    def detect(self, iq):
+        num_positions = len(iq) - self.lag - self.window + 1
+        overlap = self.lag + self.window - 1
+
+        # A run still open at the end of the previous block: (start, energy sum, length)
+        open_run = None
+        for block_start in range(0, max(num_positions, 0), self.block_size):
+            num = min(self.block_size, num_positions - block_start)
+            metric, energy = self.metric(iq[block_start:block_start + num + overlap])
+            above = metric > self.threshold
+
+            if open_run is not None and not above[0]:
+                # The open run ended with the previous block
+                if open_run[2] >= self.min_run:
+                    yield open_run[0], open_run[1] / (open_run[2] * self.window)
+                open_run = None
+
+            edges = np.diff(above.astype(np.int8), prepend=np.int8(0), append=np.int8(0))
+            starts = np.flatnonzero(edges == 1)
+            stops = np.flatnonzero(edges == -1)
+            energy_sum = np.concatenate([[0], np.cumsum(energy, dtype=np.float64)])
+
+            for start, stop in zip(starts, stops):
+                run_start, run_energy, run_len = block_start + start, energy_sum[stop] - energy_sum[start], stop - start
+                if start == 0 and open_run is not None:
+                    run_start, run_energy, run_len = open_run[0], open_run[1] + run_energy, open_run[2] + run_len
+                    open_run = None
+                if stop == num and above[-1]:
+                    # Continues in the next block
+                    open_run = (run_start, run_energy, run_len)
+                    continue
+                if run_len >= self.min_run:
+                    yield run_start, run_energy / (run_len * self.window)
+
+        if open_run is not None and open_run[2] >= self.min_run:
+            yield open_run[0], open_run[1] / (open_run[2] * self.window)
+
+# Start offsets and powers of the packets detected in a capture (see SchmidlCoxDetector)
+def detect_packets(iq, samp_rate=BASEBAND_RATE, threshold=0.5, block_size=DETECTION_BLOCK_SIZE):
+    detections = list(SchmidlCoxDetector(samp_rate, threshold, block_size).detect(iq))
+    offsets = np.array([offset for offset, _ in detections], dtype=np.int64)
+    powers = np.array([power for _, power in detections], dtype=np.float64)
+    return offsets, powers
+
+class NonHTFrame:
+    def __init__(self, offset, cfo, num_samples, rate, length, power=None):
+        self.offset = offset                # first sample of the L-STF (baseband rate)
+        self.cfo = cfo                      # carrier frequency offset (cycles/sample)
+        self.num_samples = num_samples      # samples of the whole PPDU (baseband rate)
+        self.rate = rate
+        self.length = length                # PSDU length (bytes)
+        self.power = power                  # mean power of the PPDU samples
+        self.psdu = None
+
+class NonHTReceiver:
+    # Estimate timing, CFO and channel of a frame detected at COARSE_START, and decode
+    # its L-SIG. Returns the frame (None if it couldn't be decoded) and its channel estimate.
+    def sync(self, x, coarse_start):
+        # Coarse CFO from the L-STF periodicity
+        stf = x[coarse_start + STF_PERIOD:coarse_start + STF_LEN - 2 * STF_PERIOD]
+        coarse_cfo = -np.angle(np.sum(stf[:-STF_PERIOD] * np.conj(stf[STF_PERIOD:]))) / (2 * np.pi * STF_PERIOD)
+
+        # Fine timing: the first long training symbol starts 192 samples after the
+        # L-STF start, searched around the coarse detection
+        first = coarse_start + STF_LEN + 2 * CP_LEN - 72
+        search = np.arange(first, first + 144 + 2 * FFT_LEN)
+        if search[-1] >= len(x):
+            return None, None
+        segment = x[search] * np.exp(-2j * np.pi * coarse_cfo * search)
+        corr = np.abs(np.correlate(segment, LTF_SYMBOL, 'valid'))
+        score = corr[:-FFT_LEN] + corr[FFT_LEN:]
+        ltf_start = first + int(np.argmax(score))
+        offset = ltf_start - STF_LEN - 2 * CP_LEN
+        if offset < 0:
+            return None, None
+
+        # Fine CFO from the two long training symbols
+        n = np.arange(ltf_start, ltf_start + 2 * FFT_LEN)
+        ltf = x[n] * np.exp(-2j * np.pi * coarse_cfo * n)
+        fine_cfo = -np.angle(np.sum(ltf[:FFT_LEN] * np.conj(ltf[FFT_LEN:]))) / (2 * np.pi * FFT_LEN)
+        cfo = coarse_cfo + fine_cfo
+
+        # Channel estimate (average of both long training symbols)
+        ltf = self._derotate(x, ltf_start - TIMING_BACKOFF, 2 * FFT_LEN, cfo)
+        spectrum = np.fft.fft(ltf.reshape(2, FFT_LEN), axis=1).mean(axis=0)
+        channel = np.zeros(FFT_LEN, dtype=complex)
+        bins = SUBCARRIERS[LTF_FREQ != 0] % FFT_LEN
+        channel[bins] = spectrum[bins] / LTF_FREQ[LTF_FREQ != 0]
+
+        # L-SIG: BPSK, rate 1/2, 24 bits
+        sig = self._soft_bits(x, ltf_start + 2 * FFT_LEN + CP_LEN, cfo, channel, 0, 1)
+        bits = viterbi_decode(sig, (1, 2), 24)
+        rate = RATES.get(tuple(bits[:4]))
+        length = int(np.sum(bits[5:17] << np.arange(12)))
+        if rate is None or bits[4] != 0 or np.sum(bits[:18]) % 2 != 0 or length == 0:
+            return None, None
+
+        num_symbols = int(np.ceil((16 + 8 * length + 6) / rate[3]))
+        num_samples = PREAMBLE_SIG_LEN + SYMBOL_LEN * num_symbols
+        return NonHTFrame(offset, cfo, num_samples, rate, length), channel
+
+    # Decode the first NUM_BITS bits of the DATA field (SERVICE included), descrambled
+    def decode_data(self, x, frame, channel, num_bits):
+        _, num_bpsc, coding_rate, num_dbps = frame.rate
+        num_symbols = int(np.ceil(num_bits / num_dbps))
+
+        data_start = frame.offset + PREAMBLE_SIG_LEN + CP_LEN
+        llr = [self._soft_bits(x, data_start + SYMBOL_LEN * m, frame.cfo, channel, m + 1, num_bpsc)
+               for m in range(num_symbols)]
+        bits = viterbi_decode(np.concatenate(llr), coding_rate, num_symbols * num_dbps)[:num_bits]
+
+        # The first 7 SERVICE bits are zeros: they carry the scrambler sequence
+        return bits ^ _scrambler_sequence(bits[:7], len(bits))
+
+    # Transmitter address (Address 2) of the MAC header, as 'xx:xx:xx:xx:xx:xx'
+    def transmitter_address(self, x, frame, channel):
+        if frame.length < MIN_MPDU_LEN:
+            return None
+        num_bits = min(HEADER_BITS + TRACEBACK_BITS, 16 + 8 * frame.length)
+        header = _bits_to_bytes(self.decode_data(x, frame, channel, num_bits)[16:HEADER_BITS])
+        return ':'.join(f'{byte:02x}' for byte in header[MAC_TA_BYTES])
+
+    # Decode the whole PSDU and check its FCS (CRC-32)
+    def check_fcs(self, x, frame, channel):
+        bits = self.decode_data(x, frame, channel, 16 + 8 * frame.length)
+        frame.psdu = _bits_to_bytes(bits[16:])
+        return zlib.crc32(frame.psdu[:-4]) == int.from_bytes(frame.psdu[-4:], 'little')
+
+    def _derotate(self, x, start, length, cfo):
+        n = np.arange(start, start + length)
+        return x[n] * np.exp(-2j * np.pi * cfo * n)
+
+    # Equalized data subcarriers of one OFDM symbol (SYMBOL_INDEX 0 is the L-SIG),
+    # with the common phase error removed using the pilots, and their channel power
+    def _demodulate(self, x, start, cfo, channel, symbol_index):
+        spectrum = np.fft.fft(self._derotate(x, start - TIMING_BACKOFF, FFT_LEN, cfo))
+
+        pilot_bins = PILOT_SUBCARRIERS % FFT_LEN
+        pilots = spectrum[pilot_bins] / channel[pilot_bins]
+        expected = PILOT_VALUES * PILOT_POLARITY[symbol_index % 127]
+        common_phase = np.angle(np.sum(pilots * expected))
+
+        data_bins = DATA_SUBCARRIERS % FFT_LEN
+        symbols = spectrum[data_bins] / channel[data_bins] * np.exp(-1j * common_phase)
+
+        # Subcarrier SNR (channel power), to weight the soft bits
+        csi = np.abs(channel[data_bins]) ** 2
+        return symbols, csi / np.mean(csi)
+
+    # Deinterleaved soft bits of one OFDM symbol
+    def _soft_bits(self, x, start, cfo, channel, symbol_index, num_bpsc):
+        symbols, csi = self._demodulate(x, start, cfo, channel, symbol_index)
+        llr = demap(symbols, num_bpsc) * np.repeat(csi, num_bpsc)
+        return llr[_deinterleaver(48 * num_bpsc, num_bpsc)]
+
+def _bits_to_bytes(bits):
+    # Bits are transmitted LSB first
+    bits = np.asarray(bits[:len(bits) // 8 * 8], dtype=np.uint8).reshape(-1, 8)
+    return np.packbits(bits, axis=1, bitorder='little').ravel().tobytes()
+
+# Find the frames of a given transmitter in a capture, with the same outputs as
+# find_tx_frames.m: preamble bounds (first & last sample), preamble IQ samples and
+# RSSI (dB) of every frame.
+# - iq: complex IQ samples (array or IQCapture), or the path of an fc32 .dat capture
+# - samp_rate: capture sample rate (frames are resampled to 20 MHz for decoding)
+# - search_mac_tx: transmitter MAC address 'xx:xx:xx:xx:xx:xx'
+# - preamble_len: number of samples kept per frame (capture rate), -1 for the full frame
+# - check_fcs: only keep frames whose FCS is valid (the whole PSDU is then decoded)
+def find_tx_frames(iq, samp_rate, search_mac_tx, preamble_len, detection_threshold=0.5, check_fcs=True):
+    if isinstance(iq, str):
+        iq = IQCapture(iq)
+    search_mac_tx = search_mac_tx.lower()
+    osf = samp_rate / BASEBAND_RATE
+    up, down = _resampling_ratio(samp_rate)
+
+    # 20 MHz samples of the capture from SEGMENT_START on, covering NUM_BASEBAND samples
+    def baseband(segment_start, num_baseband):
+        segment_stop = segment_start + int(np.ceil(num_baseband * osf)) + SEGMENT_MARGIN
+        segment = np.asarray(iq[segment_start:segment_stop])
+        return signal.resample_poly(segment, up, down) if up != down else segment
+
+    detector = SchmidlCoxDetector(samp_rate, detection_threshold)
+    receiver = NonHTReceiver()
+    preamble_bounds, preamble_iq, rssi = [], [], []
+    next_free = 0
+    for start, _ in detector.detect(iq):
+        if start < next_free:
+            continue
+
+        # Synchronize on the preamble, then get the samples of the whole PPDU
+        segment_start = max(0, start - SEGMENT_MARGIN)
+        x = baseband(segment_start, PREAMBLE_SIG_LEN + 2 * SEGMENT_MARGIN)
+        frame, channel = receiver.sync(x, int(round((start - segment_start) / osf)))
+        if frame is None:
+            continue
+        frame_end = frame.offset + frame.num_samples
+        x = baseband(segment_start, frame_end)
+        if frame_end > len(x):
+            # Incomplete packet at the end of the capture
+            continue
+        frame.power = np.mean(np.abs(x[frame.offset:frame_end]) ** 2)
+
+        # Skip the rest of this PPDU
+        next_free = segment_start + int(round(frame_end * osf))
+
+        if receiver.transmitter_address(x, frame, channel) != search_mac_tx:
+            continue
+        if check_fcs and not receiver.check_fcs(x, frame, channel):
+            continue
+
+        # Frame bounds at the capture sample rate
+        samples_start = segment_start + int(round(frame.offset * osf))
+        if preamble_len == -1:
+            samples_end = samples_start + int(round(frame.num_samples * osf))
+        else:
+            samples_end = samples_start + preamble_len
+        if samples_end > len(iq):
+            continue
+
+        preamble_bounds.append([samples_start, samples_end - 1])
+        # Only this window of the capture is read
+        preamble_iq.append(np.array(iq[samples_start:samples_end]))
+        rssi.append(round(10 * np.log10(frame.power), 2))
+
+    print(f'Found {len(preamble_bounds)} TX frames.')
+
+    if preamble_len != -1:
+        preamble_iq = np.array(preamble_iq).reshape(-1, preamble_len)
+    return {
+        'preamble_bounds': np.array(preamble_bounds, dtype=int).reshape(-1, 2),
+        'preamble_iq': preamble_iq,
+        'rssi': np.array(rssi)
+    }
+
+def _resampling_ratio(samp_rate):
+    ratio = np.round(BASEBAND_RATE / samp_rate * 1000).astype(int)
+    gcd = np.gcd(ratio, 1000)
+    return int(ratio // gcd), int(1000 // gcd)
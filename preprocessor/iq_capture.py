@@ -0,0 +1,185 @@
+import os
+import re
+import threading
+import numpy as np
+
+# GNU Radio captures (receive_capture.py) are raw interleaved float32 I/Q samples,
+# i.e. complex64 (fc32) with no header
+IQ_DTYPE = np.complex64
+
+# Extracts signal configs from a file name in a dataset
+# - filename: name of the .dat file (without the route)
+def parse_dat_name(filename):
+    # Extract node_tx
+    node_tx_match = re.search(r'tx\{node_(.*?)\}', filename)
+    node_tx = node_tx_match.group(1) if node_tx_match else None
+
+    # Extract node_rx
+    node_rx_match = re.search(r'rx\{node_(.*?)[\+\}]', filename)
+    node_rx = node_rx_match.group(1) if node_rx_match else None
+
+    # Extract samp_rate
+    samp_rate_match = re.search(r'rxSampRate_(\d+e\d+)', filename)
+    samp_rate = float(samp_rate_match.group(1)) if samp_rate_match else None
+
+    return {
+        "node_tx": node_tx,
+        "node_rx": node_rx,
+        "samp_rate": samp_rate
+    }
+
+# Read-only view of an fc32 .dat capture, memory-mapped instead of loaded: slicing
+# (capture[start:stop]) and windows are views of the file pages, so only the samples
+# actually used are read from disk.
+class IQCapture:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.name = os.path.basename(file_path)
+
+        # Signal configs from the file name (None when not in the dataset naming scheme)
+        config = parse_dat_name(self.name)
+        self.node_tx = config['node_tx']
+        self.node_rx = config['node_rx']
+        self.samp_rate = config['samp_rate']
+
+        if os.path.getsize(file_path) < np.dtype(IQ_DTYPE).itemsize:
+            # np.memmap can't map an empty file
+            self.samples = np.zeros(0, dtype=IQ_DTYPE)
+        else:
+            self.samples = np.memmap(file_path, dtype=IQ_DTYPE, mode='r')
+
+    def __len__(self):
+        return len(self.samples)
+
+    # Samples by offset: capture[offset], capture[start:stop] (a view, no copy)
+    def __getitem__(self, key):
+        return self.samples[key]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def duration(self):
+        return len(self) / self.samp_rate if self.samp_rate else None
+
+    # Copy of LENGTH samples from sample offset START (shorter at the end of the capture)
+    def read(self, start, length):
+        return np.array(self.samples[start:start + length])
+
+    # Iterate over (offset, window) views of SIZE samples, each overlapping the next
+    # one by OVERLAP samples; the last window may be shorter
+    def windows(self, size, overlap=0):
+        if not 0 <= overlap < size:
+            raise Exception('Invalid window overlap. Accepted options: [0, size)')
+        if len(self) == 0:
+            return
+        step = size - overlap
+        for start in range(0, max(len(self) - overlap, 1), step):
+            yield start, self.samples[start:start + size]
+
+    # Release the file mapping (views obtained before remain valid until deleted)
+    def close(self):
+        self.samples = np.zeros(0, dtype=IQ_DTYPE)
+
+# Capture received as a stream (e.g. ranged GETs of an S3 object) into a ring buffer of
+# CAPACITY samples, with the same slicing interface as IQCapture, so that frames are
+# detected while the file is still being received, without writing it to disk.
+# - A producer thread write()s the bytes in order, and waits while the buffer is full
+# - The consumer reads slices in (roughly) increasing order; a slice waits until its
+#   samples are received. Samples more than HISTORY samples before the start of the
+#   last slice read are released, reading them again raises an exception.
+class IQStream:
+    def __init__(self, name, num_samples, capacity=2**22, history=2**21):
+        if history >= capacity:
+            raise Exception('Invalid stream history. Accepted options: [0, capacity)')
+        self.name = name
+        config = parse_dat_name(name)
+        self.node_tx = config['node_tx']
+        self.node_rx = config['node_rx']
+        self.samp_rate = config['samp_rate']
+
+        self.num_samples = num_samples
+        self.capacity = capacity
+        self.history = history
+        self.buffer = np.zeros(capacity, dtype=IQ_DTYPE)
+        self.written = 0
+        self.released = 0
+        self.error = None
+        self.closed = False
+        self._partial = b''
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return self.num_samples
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # Producer: append received bytes; returns False once the stream is closed
+    def write(self, data):
+        data = self._partial + bytes(data)
+        num_bytes = len(data) - len(data) % np.dtype(IQ_DTYPE).itemsize
+        self._partial = data[num_bytes:]
+        samples = np.frombuffer(data[:num_bytes], dtype=IQ_DTYPE)
+
+        while len(samples):
+            with self._cond:
+                self._cond.wait_for(lambda: self.closed or self.written - self.released < self.capacity)
+                if self.closed:
+                    return False
+                # Up to the free space and the end of the ring
+                position = self.written % self.capacity
+                count = min(len(samples), self.capacity - (self.written - self.released), self.capacity - position)
+                self.buffer[position:position + count] = samples[:count]
+                self.written += count
+                self._cond.notify_all()
+            samples = samples[count:]
+        return True
+
+    # Producer: the stream can't be completed, pending and later reads raise ERROR
+    def fail(self, error):
+        with self._cond:
+            self.error = error
+            self._cond.notify_all()
+
+    # Copy of the samples of a slice, once received
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            raise Exception('Invalid stream index. Accepted options: [slice]')
+        start, stop, step = key.indices(self.num_samples)
+        if step != 1:
+            raise Exception('Invalid stream slice step. Accepted options: [1]')
+        stop = max(start, stop)
+
+        with self._cond:
+            if start < self.released:
+                raise Exception(f'Samples {start}:{stop} of {self.name} were released from the stream buffer')
+            # Everything HISTORY samples before this slice can be overwritten
+            released = max(self.released, start - self.history)
+            if stop - released > self.capacity:
+                raise Exception(f'Samples {start}:{stop} of {self.name} exceed the stream buffer')
+            self.released = released
+            self._cond.notify_all()
+
+            self._cond.wait_for(lambda: self.error is not None or self.closed or self.written >= stop)
+            if self.error is not None:
+                raise self.error
+            if self.closed:
+                raise Exception(f'Stream {self.name} is closed')
+
+            # The slice may wrap around the end of the ring
+            position = start % self.capacity
+            head = self.buffer[position:position + stop - start]
+            return np.concatenate([head, self.buffer[:stop - start - len(head)]])
+
+    # Stop the producer (blocked writes return False)
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
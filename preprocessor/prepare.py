@@ -2,13 +2,19 @@ import os
 import numpy as np
 import queue
 import concurrent.futures
-import re
+import multiprocessing
 import h5py
 import json
-from collections import defaultdict
+import threading
 import boto3
 from tqdm import tqdm
-import matlab.engine
+from frame_detection import find_tx_frames
+from iq_capture import IQCapture, IQStream, parse_dat_name
+try:
+    import matlab.engine
+except ImportError:
+    # Only needed with FRAME_DECODER = 'matlab'
+    matlab = None
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -18,6 +24,9 @@ s3 = boto3.client('s3')
 ROOT_DIR = '/home/smazokha2016/Desktop'
 # ROOT_DIR = '/Users/stepanmazokha/Desktop'
 
+# Frame detection & MAC decoding: 'numpy' (frame_detection.py, one decode per CPU core)
+# or 'matlab' (find_tx_frames.m through the shared MATLAB engines of MATLAB_SESSION_NAMES)
+FRAME_DECODER = 'numpy'
 MATLAB_OFDM_DECODER = ROOT_DIR + '/mobintel-rffi/preprocessor/frame_mac_detection'
 TEMP_IQ_DIRECTORY = ROOT_DIR + '/orbit_processor_temp/'
 NODE_MACS = 'experiment_device_macs.json'
@@ -29,8 +38,29 @@ S3_TRAINING_PREFIX = "training_"
 RFFI_DATASET_TARGET_DIR = f'{ROOT_DIR}/{S3_BUCKET_NAME}_h5/'
 FRAME_COUNT = 200
 
+# With the NumPy decoder, stream the .dat files from S3 (ranged GETs of S3_RANGE_SIZE 
+# bytes) straight into the frame detector, instead of downloading them to TEMP_IQ_DIRECTORY
+S3_STREAMING = True
+S3_RANGE_SIZE = 8 * 2**20
+
+# On-disk layout of the epoch datasets:
+# - 1: contiguous, uncompressed float64 'data' (interleaved I/Q), float64 'label' 
+#      and 'rssi' (memory-mappable, see LazyRFDataset)
+# - 2: row-chunked, gzip-compressed float32 'data' (interleaved I/Q), integer 
+#      'label' grouped by device, a 'label_index' group with per-device offsets 
+#      and capture attributes (sample rate, rx node, session, preamble length)
+# Datasets are resizable while a session is written, so that files are appended to as 
+# frames are decoded; v1 files are rewritten contiguous once the session is complete.
+H5_FORMAT_VERSION = 2
+H5_CHUNK_ROWS = 64
+H5_COMPRESSION = 'gzip'
+H5_COMPRESSION_LEVEL = 4
+
 COMPLETED_SESSIONS = []
 
+# Record of the processed .dat files (in RFFI_DATASET_TARGET_DIR), used to resume sessions
+MANIFEST_NAME = 'manifest.jsonl'
+
 MATLAB_SESSION_NAMES = [
     'mobintel_session_1',
     'mobintel_session_2', 
@@ -45,28 +75,11 @@ MATLAB_SESSION_NAMES = [
 
 # MATLAB_SESSION_NAMES = ['mobintel_session_1']
 
-MAX_THREADS = len(MATLAB_SESSION_NAMES)
-
-# Extracts signal configs from a file name in a dataset
-# - filename: name of the .dat file (without the route)
-def parse_dat_name(filename):
-    # Extract node_tx
-    node_tx_match = re.search(r'tx\{node_(.*?)\}', filename)
-    node_tx = node_tx_match.group(1) if node_tx_match else None
-
-    # Extract node_rx
-    node_rx_match = re.search(r'rx\{node_(.*?)[\+\}]', filename)
-    node_rx = node_rx_match.group(1) if node_rx_match else None
-
-    # Extract samp_rate
-    samp_rate_match = re.search(r'rxSampRate_(\d+e\d+)', filename)
-    samp_rate = float(samp_rate_match.group(1)) if samp_rate_match else None
-
-    return {
-        "node_tx": node_tx,
-        "node_rx": node_rx,
-        "samp_rate": samp_rate
-    }
+# Parallel .dat file pipelines (download, detect, extract, filter by MAC) with the NumPy 
+# decoder: 'process' (one worker process per core, the FRAME_COUNT preambles of each file 
+# come back with its result) or 'thread'. MATLAB engines always use threads.
+DAT_EXECUTOR = 'process'
+MAX_WORKERS = len(MATLAB_SESSION_NAMES) if FRAME_DECODER == 'matlab' else os.cpu_count()
 
 # Reads a JSON file containing MAC addresses of devices
 def read_json_file(file_path):
@@ -99,6 +112,35 @@ def download_file_with_progress(bucket_name, s3_key, local_path):
     s3.download_file(bucket_name, s3_key, local_path, Callback=callback)
     callback.progress_bar.close()
 
+# Feeds an S3 object to an IQStream with ranged GETs (run in a background thread)
+def stream_s3_object(bucket_name, s3_key, stream, total_size):
+    s3 = boto3.client('s3')
+    callback = TqdmCallback(total_size)
+    try:
+        received = 0
+        for range_start in range(0, total_size, S3_RANGE_SIZE):
+            range_end = min(range_start + S3_RANGE_SIZE, total_size) - 1
+            response = s3.get_object(Bucket=bucket_name, Key=s3_key, Range=f'bytes={range_start}-{range_end}')
+            for chunk in response['Body'].iter_chunks(2**20):
+                if not stream.write(chunk):
+                    # Closed by the consumer
+                    return
+                received += len(chunk)
+                callback(len(chunk))
+        if received != total_size:
+            raise Exception(f'Received {received} of {total_size} bytes of {s3_key}')
+    except Exception as e:
+        stream.fail(e)
+    finally:
+        callback.progress_bar.close()
+
+# Opens an S3 .dat file as an IQStream, being received in the background
+def open_s3_stream(bucket_name, s3_key):
+    total_size = s3.head_object(Bucket=bucket_name, Key=s3_key)['ContentLength']
+    stream = IQStream(os.path.basename(s3_key), total_size // np.dtype(np.complex64).itemsize)
+    threading.Thread(target=stream_s3_object, args=(bucket_name, s3_key, stream, total_size), daemon=True).start()
+    return stream
+
 def s3_list_subdirs(bucket_name, prefix):
     response = s3.list_objects_v2(Bucket=bucket_name, Prefix=prefix, Delimiter='/')
     
@@ -139,43 +181,285 @@ def generate_node_ids():
             node_i = node_i + 1
     return ids
 
-# Save an h5 dataset file containing labels & data for a given set of devices
-def save_dataset_h5(file_target, label, data, rssi):
-    print('Saving', file_target)
+# Store the per-device row ranges of a v2 file. Rows of each device must be one
+# contiguous range (e.g. sorted labels, or appended one TX node block at a time)
+def save_label_index(h5file, label):
+    label = np.ravel(label)
+
+    # Runs of equal labels
+    starts = np.flatnonzero(np.r_[True, label[1:] != label[:-1]])
+    devices = label[starts]
+    if len(np.unique(devices)) != len(devices):
+        # A device spans several row ranges: readers fall back to scanning the labels
+        print('Skipping label index: device rows are not contiguous')
+        return
+    counts = np.diff(np.r_[starts, len(label)])
+
+    # Rows of devices[i] are [offsets[i], offsets[i] + counts[i])
+    order = np.argsort(devices)
+    label_index = h5file.create_group('label_index')
+    label_index.create_dataset('labels', data=devices[order], dtype='int32')
+    label_index.create_dataset('offsets', data=starts[order], dtype='int64')
+    label_index.create_dataset('counts', data=counts[order], dtype='int64')
+
+# Create the empty, resizable label, rssi & data datasets of an h5 file (layout of
+# H5_FORMAT_VERSION), to be appended to block by block
+# - attrs: capture information, stored in v2 files only
+def create_dataset_h5(h5file, row_len, attrs):
+    if H5_FORMAT_VERSION == 2:
+        h5file.attrs['format_version'] = 2
+        for name, value in attrs.items():
+            h5file.attrs[name] = value
+
+        label = h5file.create_dataset('label', (0,), maxshape=(None,), dtype='int32')
+        rssi = h5file.create_dataset('rssi', (0,), maxshape=(None,), dtype='float32')
+        data = h5file.create_dataset('data', (0, row_len), maxshape=(None, row_len), dtype='float32',
+                                     chunks=(H5_CHUNK_ROWS, row_len),
+                                     compression=H5_COMPRESSION,
+                                     compression_opts=H5_COMPRESSION_LEVEL,
+                                     shuffle=True)
+    else:
+        label = h5file.create_dataset('label', (0, 1), maxshape=(None, 1), dtype='float64')
+        rssi = h5file.create_dataset('rssi', (0, 1), maxshape=(None, 1), dtype='float64')
+        data = h5file.create_dataset('data', (0, row_len), maxshape=(None, row_len), dtype='float64',
+                                     chunks=(H5_CHUNK_ROWS, row_len))
+
+    return label, rssi, data
+
+# Copy the label, rssi & data datasets (and attributes) of an h5 file to a new file
+# with contiguous, uncompressed datasets, BLOCK_ROWS rows at a time
+def save_contiguous_h5(src_h5file, file_target, block_rows=H5_CHUNK_ROWS * 64):
     with h5py.File(file_target, 'w') as h5file:
-        h5file.create_dataset('label', data=label, dtype='float64')
-        h5file.create_dataset('rssi', data=rssi, dtype='float64')
-        h5file.create_dataset('data', data=data, dtype='float64')  
-
-# Package & store epoch infromation in h5 file (ready for RFFI)
-def epoch_save(node_ids_dict, target_dir, epoch_preambles, session_name, preamble_len):
-    for rx_name in epoch_preambles.keys():
-        rx_epochs = epoch_preambles[rx_name]
-
-        # Data shape: (epochs x frames, samples x 2)
-        # All frames/samples from all emitters are stitched together
-        h5_data = np.zeros((len(rx_epochs) * FRAME_COUNT, preamble_len * 2), dtype='float64')
-        # Labels shape: (epochs x frames, 1)
-        h5_labels = np.zeros((len(rx_epochs) * FRAME_COUNT, 1), dtype='float64')
-        # RSSI shape: (epochs x frames, 1)
-        h5_rssi = np.zeros((len(rx_epochs) * FRAME_COUNT, 1), dtype='float64')
-
-        h5_idx = 0
-        for rx_epoch in rx_epochs:
-            preambles = rx_epoch['preambles']
-            rssi = rx_epoch['rssi']
-            tx_node_name = rx_epoch['node_tx']
-            for preamble_i in np.arange(0, preambles.shape[0]):
-                h5_data[h5_idx, 0::2] = np.real(preambles[preamble_i, :])
-                h5_data[h5_idx, 1::2] = np.imag(preambles[preamble_i, :])
-
-                h5_labels[h5_idx] = node_ids_dict[tx_node_name]
-                h5_rssi[h5_idx] = rssi[preamble_i]
-
-                h5_idx = h5_idx + 1
-
-        dataset_filepath = os.path.join(target_dir, f'node{rx_name}_{session_name}.h5')
-        save_dataset_h5(dataset_filepath, h5_labels, h5_data, h5_rssi)
+        for name, value in src_h5file.attrs.items():
+            h5file.attrs[name] = value
+        for name in ('label', 'rssi', 'data'):
+            src = src_h5file[name]
+            dst = h5file.create_dataset(name, src.shape, dtype=src.dtype)
+            for start in range(0, src.shape[0], block_rows):
+                dst[start:start + block_rows] = src[start:start + block_rows]
+
+# Convert complex preambles (frames x samples) to rows of interleaved I/Q values 
+# [I0, Q0, I1, Q1, ...] of a given float dtype, without a per-frame loop
+def preambles_to_rows(preambles, dtype):
+    complex_dtype = np.result_type(dtype, np.complex64)
+    return np.ascontiguousarray(preambles, dtype=complex_dtype).view(dtype)
+
+# Append-only JSON lines record of every processed (session, .dat file): status, frame 
+# count and the rows it occupies in its RX dataset file. Statuses:
+# - 'appended': frames flushed to the temporary RX file of the session
+# - 'done': frames in the final RX file
+# - 'insufficient' / 'failed': not enough frames / error (failed files are retried)
+# The last record of a file wins; a rerun only processes files that are missing or failed.
+class Manifest:
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.lock = threading.Lock()
+        self.records = {}
+
+        if os.path.exists(file_path):
+            with open(file_path, 'r') as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Line cut short by an interrupted run
+                        continue
+                    self.records[(record['session'], record['dat_file'])] = record
+
+    def status(self, session_name, dat_file):
+        record = self.records.get((session_name, dat_file))
+        return record['status'] if record else None
+
+    # .dat files of a session that still need to be processed
+    def pending(self, session_name, dat_files):
+        return [dat_file for dat_file in dat_files 
+                if self.status(session_name, dat_file) not in ('appended', 'done', 'insufficient')]
+
+    # Records of the .dat files of a session stored in an RX file ('appended' or 'done'), 
+    # by RX node
+    def stored(self, session_name):
+        stored = {}
+        for (session, _), record in self.records.items():
+            if session == session_name and record['status'] in ('appended', 'done'):
+                stored.setdefault(record['rx_node'], []).append(record)
+        return stored
+
+    def record(self, session_name, dat_file, status, **fields):
+        record = {'session': session_name, 'dat_file': dat_file, 'status': status, **fields}
+        with self.lock:
+            with open(self.file_path, 'a') as file:
+                file.write(json.dumps(record) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            self.records[(session_name, dat_file)] = record
+
+# Streams the frames of a session into one h5 file per RX node, as .dat files complete.
+# Every appended block is flushed to disk, so memory holds a single .dat file's frames.
+# Files are written under a temporary name and only renamed to node{rx}_{session}.h5 
+# by finalize(): an interrupted session never leaves a truncated dataset behind.
+# With a manifest, every .dat file is recorded once its rows are flushed ('appended', 
+# with its row offset), then as 'done' once the file is in place. A resumed session 
+# rebuilds its RX files (temporary file of an interrupted run, else the final file) in 
+# the resizable layout, keeping only the rows confirmed by the manifest.
+class EpochWriter:
+    def __init__(self, node_ids_dict, target_dir, session_name, preamble_len, manifest=None):
+        self.node_ids_dict = node_ids_dict
+        self.target_dir = target_dir
+        self.session_name = session_name
+        self.preamble_len = preamble_len
+        self.manifest = manifest
+        # rx_name -> {'h5file', 'label', 'rssi', 'data', 'appended', 'path'}
+        self.rx_files = {}
+
+    # Reopen the RX files of an interrupted run (files appended but not finalized), so
+    # that finalize() completes them even if no .dat file is left to process
+    def recover(self):
+        if self.manifest is None:
+            return
+        for rx_name, records in self.manifest.stored(self.session_name).items():
+            if rx_name not in self.rx_files and any(record['status'] == 'appended' for record in records):
+                self._open(rx_name, None)
+
+    def _open(self, rx_name, samp_rate):
+        dataset_filepath = os.path.join(self.target_dir, f'node{rx_name}_{self.session_name}.h5')
+        tmp_filepath = dataset_filepath + '.tmp'
+        attrs = {
+            'samp_rate': samp_rate,
+            'rx_node': rx_name,
+            'session': self.session_name,
+            'preamble_len': self.preamble_len
+        }
+
+        records = []
+        if self.manifest is not None:
+            records = self.manifest.stored(self.session_name).get(rx_name, [])
+        # Rows of an interrupted run are in the temporary file, else in the final one
+        source_filepath = next((path for path in (tmp_filepath, dataset_filepath) if os.path.exists(path)), None)
+
+        appended = []
+        if records and source_filepath is not None:
+            # Resumed session: rebuild the file from its confirmed rows
+            appended = self._rebuild(source_filepath, tmp_filepath + '.resume', records, attrs)
+            os.replace(tmp_filepath + '.resume', tmp_filepath)
+            h5file = h5py.File(tmp_filepath, 'a')
+            label, rssi, data = h5file['label'], h5file['rssi'], h5file['data']
+        else:
+            for record in records:
+                # Rows recorded, but the RX file is gone
+                self.manifest.record(self.session_name, record['dat_file'], 'failed')
+            h5file = h5py.File(tmp_filepath, 'w')
+            attrs = {name: value for name, value in attrs.items() if value is not None}
+            label, rssi, data = create_dataset_h5(h5file, self.preamble_len * 2, attrs)
+        self.rx_files[rx_name] = {
+            'h5file': h5file,
+            'label': label,
+            'rssi': rssi,
+            'data': data,
+            'appended': appended,
+            'path': dataset_filepath
+        }
+        return self.rx_files[rx_name]
+
+    # Copy the rows of RECORDS (manifest records) from an existing RX file to a new file 
+    # in the create_dataset_h5 layout (baseline and v1 datasets are not resizable). Rows 
+    # not confirmed by the manifest are dropped, and files whose rows are missing are 
+    # recorded as failed (processed again). Returns the kept 'appended' records.
+    def _rebuild(self, source_filepath, file_target, records, attrs, block_rows=H5_CHUNK_ROWS * 64):
+        with h5py.File(source_filepath, 'r') as src:
+            available = src['data'].shape[0]
+            kept = []
+            for record in records:
+                if record['offset'] + record['frame_count'] <= available:
+                    kept.append(record)
+                else:
+                    print(f"Rows of {record['dat_file']} missing from {source_filepath}")
+                    self.manifest.record(self.session_name, record['dat_file'], 'failed')
+            num_rows = max((record['offset'] + record['frame_count'] for record in kept), default=0)
+            print(f'Resuming {source_filepath}: {num_rows} of {available} rows confirmed')
+
+            attrs = {**attrs, **{name: value for name, value in src.attrs.items() if name in attrs}}
+            attrs = {name: value for name, value in attrs.items() if value is not None}
+            with h5py.File(file_target, 'w') as h5file:
+                dsets = create_dataset_h5(h5file, src['data'].shape[1], attrs)
+                for name, dst in zip(('label', 'rssi', 'data'), dsets):
+                    dst.resize(num_rows, axis=0)
+                    for start in range(0, num_rows, block_rows):
+                        stop = min(start + block_rows, num_rows)
+                        block = np.asarray(src[name][start:stop]).reshape((stop - start,) + dst.shape[1:])
+                        dst[start:stop] = block.astype(dst.dtype)
+
+        return [{'dat_file': record['dat_file'], 'frame_count': record['frame_count'], 'offset': record['offset']}
+                for record in kept if record['status'] == 'appended']
+
+    # Append the frames of one .dat file (output of process_dat_file)
+    def append(self, file_preambles, dat_file=None):
+        rx_name = file_preambles['node_rx']
+        rx_file = self.rx_files.get(rx_name) or self._open(rx_name, file_preambles['samp_rate'])
+        label_dset, rssi_dset, data_dset = rx_file['label'], rx_file['rssi'], rx_file['data']
+
+        # Frames, labels and RSSI as whole slices
+        rows = preambles_to_rows(file_preambles['preambles'], data_dset.dtype)
+        frame_count = rows.shape[0]
+        label = np.full(frame_count, self.node_ids_dict[file_preambles['node_tx']], dtype='int32')
+        rssi = np.asarray(file_preambles['rssi'])[:frame_count]
+
+        start = data_dset.shape[0]
+        block = slice(start, start + frame_count)
+        for dset in (label_dset, rssi_dset, data_dset):
+            dset.resize(start + frame_count, axis=0)
+        data_dset[block] = rows
+        label_dset[block] = label.reshape((frame_count,) + label_dset.shape[1:])
+        rssi_dset[block] = rssi.reshape((frame_count,) + rssi_dset.shape[1:])
+        rx_file['appended'].append({'dat_file': dat_file, 'frame_count': frame_count, 'offset': start})
+
+        rx_file['h5file'].flush()
+        if self.manifest is not None and dat_file is not None:
+            # The rows are on disk: the file won't be processed again
+            self.manifest.record(self.session_name, dat_file, 'appended',
+                                 rx_node=rx_name,
+                                 output=os.path.basename(rx_file['path']),
+                                 frame_count=frame_count,
+                                 offset=start)
+
+    # Complete every RX file (label index), move it to its final name and record 
+    # its .dat files in the manifest
+    def finalize(self):
+        for rx_name, rx_file in self.rx_files.items():
+            h5file = rx_file['h5file']
+            tmp_filepath = rx_file['path'] + '.tmp'
+            if H5_FORMAT_VERSION == 2:
+                # Rebuilt over all rows (a resumed file already has an index)
+                if 'label_index' in h5file:
+                    del h5file['label_index']
+                save_label_index(h5file, rx_file['label'][:])
+                h5file.close()
+            else:
+                # Appended datasets are chunked: rewrite them contiguous
+                save_contiguous_h5(h5file, rx_file['path'] + '.contiguous.tmp')
+                h5file.close()
+                os.remove(tmp_filepath)
+                tmp_filepath = rx_file['path'] + '.contiguous.tmp'
+            os.replace(tmp_filepath, rx_file['path'])
+            print('Saved', rx_file['path'])
+
+            if self.manifest is None:
+                continue
+            for appended in rx_file['appended']:
+                self.manifest.record(self.session_name, appended['dat_file'], 'done',
+                                     rx_node=rx_name,
+                                     output=os.path.basename(rx_file['path']),
+                                     frame_count=appended['frame_count'],
+                                     offset=appended['offset'])
+        self.rx_files = {}
+
+    # Close the files of an incomplete session. With a manifest, the temporary files are 
+    # kept: the next run resumes from their confirmed rows
+    def abort(self):
+        for rx_name, rx_file in self.rx_files.items():
+            rx_file['h5file'].close()
+            if self.manifest is None:
+                os.remove(rx_file['path'] + '.tmp')
+        self.rx_files = {}
 
 def is_session_valid(session_name):
     return session_name[0:6] == 'epoch_' or session_name[0:9] == 'training_'
@@ -183,11 +467,13 @@ def is_session_valid(session_name):
 def process_dat_file(matlab_engine, session_name, dat_file, node_macs, preamble_len):
     print(f"Processing {dat_file}")
 
-    # 3.1. Download the file from S3
+    # 3.1. Download the file from S3 (or stream it during the decoding)
     s3_filepath = f"{S3_EXPERIMENT_NAME}/{session_name}/{dat_file}"
     local_filepath = os.path.join(TEMP_IQ_DIRECTORY, dat_file)
-    print(f'Downloading {dat_file}...')
-    download_file_with_progress(S3_BUCKET_NAME, s3_filepath, local_filepath)
+    streaming = matlab_engine is None and S3_STREAMING
+    if not streaming:
+        print(f'Downloading {dat_file}...')
+        download_file_with_progress(S3_BUCKET_NAME, s3_filepath, local_filepath)
 
     # 3.2. Extract signal info from its name
     dat_config = parse_dat_name(dat_file)
@@ -198,8 +484,16 @@ def process_dat_file(matlab_engine, session_name, dat_file, node_macs, preamble_
     # 3.3. Retrieve node MAC address
     tx_mac = node_macs[tx_name]['mac']
 
-    # 3.2. Decode the file via MATLAB script, extract preambles
-    response = matlab_engine.find_tx_frames(local_filepath, 'CBW20', samp_rate, tx_mac, preamble_len)
+    # 3.2. Decode the file (MATLAB script or NumPy receiver), extract preambles
+    if streaming:
+        print(f'Streaming {dat_file}...')
+        with open_s3_stream(S3_BUCKET_NAME, s3_filepath) as capture:
+            response = find_tx_frames(capture, samp_rate, tx_mac, preamble_len)
+    elif matlab_engine is None:
+        with IQCapture(local_filepath) as capture:
+            response = find_tx_frames(capture, samp_rate, tx_mac, preamble_len)
+    else:
+        response = matlab_engine.find_tx_frames(local_filepath, 'CBW20', samp_rate, tx_mac, preamble_len)
     # preamble_bounds = np.array(response['preamble_bounds']).squeeze()
     preamble_iq = np.array(response['preamble_iq']).squeeze()
     rssi = np.array(response['rssi']).squeeze()
@@ -211,57 +505,98 @@ def process_dat_file(matlab_engine, session_name, dat_file, node_macs, preamble_
             'rssi': rssi,
             'node_tx': tx_name,
             'node_rx': rx_name,
-            'node_mac': tx_mac
+            'node_mac': tx_mac,
+            'samp_rate': samp_rate
         }
     else: file_preambles = None
 
     # 3.4. Remove local file afer the processing is completed
-    print(f"Deleting local file {local_filepath}")
-    os.remove(local_filepath)
+    if not streaming:
+        print(f"Deleting local file {local_filepath}")
+        os.remove(local_filepath)
 
     return file_preambles
 
-def process_session(matlab_engine_queue, session_name, preamble_len, node_ids, node_macs):
+# Process pool worker: runs process_dat_file with the NumPy decoder; only the selected 
+# preambles (a FRAME_COUNT x preamble_len block) are sent back to the main process
+def process_dat_file_worker(session_name, dat_file, node_macs, preamble_len):
+    try:
+        return (process_dat_file(None, session_name, dat_file, node_macs, preamble_len), dat_file, False)
+    except Exception as e:
+        print(f"Something happened: {dat_file}")
+        print(e)
+        return (None, dat_file, True)
+
+def process_session(matlab_engine_queue, session_name, preamble_len, node_ids, node_macs, manifest):
     if not is_session_valid(session_name):
         print("Skipping session", session_name)
         return
     else: print("Processing session ", session_name)
 
-    # Retrieve list of all .dat files to process
+    # Retrieve list of all .dat files to process, except those already processed
     session_dat_files = s3_list_files(S3_BUCKET_NAME, S3_EXPERIMENT_NAME + "/" + session_name + "/")
 
-    # Prepare a dictionary to store preambles for this session (aka epoch)
-    epoch_preambles = defaultdict(list)
+    # Stream the preambles of this session (aka epoch) into per-RX dataset files, starting
+    # with the files of an interrupted run (which may turn some files back to pending)
+    writer = EpochWriter(node_ids, RFFI_DATASET_TARGET_DIR, session_name, preamble_len, manifest)
+    writer.recover()
+
+    pending_dat_files = manifest.pending(session_name, session_dat_files)
+    if not pending_dat_files:
+        writer.finalize()
+        print(f"Session {session_name} already completed.")
+        return
+    print(f"{len(session_dat_files) - len(pending_dat_files)} of {len(session_dat_files)} files already processed.")
 
     # Define a worker function that would prepare a matlab engine for work
+    # (no engine queue with the NumPy decoder)
     def worker(session_name, dat_file, node_macs, preamble_len):
         # Retrieve name of the session
-        matlab_engine = matlab_engine_queue.get()
+        matlab_engine = matlab_engine_queue.get() if matlab_engine_queue is not None else None
         dat_file_preambles = None
+        failed = False
         try:
             dat_file_preambles = process_dat_file(matlab_engine, session_name, dat_file, node_macs, preamble_len)
         except Exception as e:
             print(f"Something happened: {dat_file}")
             print(e)
+            failed = True
         finally:
-            matlab_engine_queue.put(matlab_engine)
-        return (dat_file_preambles, dat_file)
+            if matlab_engine_queue is not None:
+                matlab_engine_queue.put(matlab_engine)
+        return (dat_file_preambles, dat_file, failed)
+
+    # Initialize parallel analysis for all .dat files: worker processes for the NumPy 
+    # decoder (spawned, so that each one has its own S3 client), threads otherwise
+    if matlab_engine_queue is None and DAT_EXECUTOR == 'process':
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        task = process_dat_file_worker
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
+        task = worker
 
-    # Initialize parallel analysis for all .dat files
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS) as executor:
-        futures = [executor.submit(worker, session_name, dat_file, node_macs, preamble_len) for dat_file in session_dat_files]
-        concurrent.futures.wait(futures)
-
-        for future in concurrent.futures.as_completed(futures):
-            dat_file_preambles, dat_file = future.result()
-
-            if dat_file_preambles:
-                rx_name = dat_file_preambles['node_rx']
-                epoch_preambles[rx_name].append(dat_file_preambles)
-            else: print(f"Insufficient frames captured: {dat_file}")
+    try:
+        with executor:
+            futures = [executor.submit(task, session_name, dat_file, node_macs, preamble_len) for dat_file in pending_dat_files]
+
+            # Write each file's frames as soon as it is decoded
+            for future in concurrent.futures.as_completed(futures):
+                dat_file_preambles, dat_file, failed = future.result()
+
+                if dat_file_preambles:
+                    writer.append(dat_file_preambles, dat_file)
+                elif failed:
+                    # Retried on the next run
+                    manifest.record(session_name, dat_file, 'failed')
+                else: 
+                    print(f"Insufficient frames captured: {dat_file}")
+                    manifest.record(session_name, dat_file, 'insufficient')
+    except:
+        writer.abort()
+        raise
 
-    # Save information for this session/epoch into a final dataset file
-    epoch_save(node_ids, RFFI_DATASET_TARGET_DIR, epoch_preambles, session_name, preamble_len)
+    # Move the completed session/epoch dataset files to their final names
+    writer.finalize()
 
     print(f"Session {session_name} processing is complete.")
     print("=========================================================================")
@@ -300,6 +635,9 @@ def main():
     # Generate a dictionary of node IDs
     node_ids = generate_node_ids()
 
+    # Load the record of already processed .dat files (to resume interrupted sessions)
+    manifest = Manifest(os.path.join(RFFI_DATASET_TARGET_DIR, MANIFEST_NAME))
+
     # Let the user chose whether to run all sessions (from S3) or just one
     requested_session = request_mode_session()
     if requested_session: 
@@ -309,13 +647,15 @@ def main():
     print(f"Starting to process {len(sessions)} sessions.")
 
     # Initialize a queue that would store all available Matlab engine instances
-    matlab_engine_queue = queue.Queue()
-    for engine_name in MATLAB_SESSION_NAMES:
-        print(f"Connecting to engine {engine_name}... ", end='')
-        matlab_engine = matlab.engine.connect_matlab(engine_name)
-        matlab_engine.cd(MATLAB_OFDM_DECODER, nargout=0)
-        matlab_engine_queue.put(matlab_engine)
-        print("connected")
+    matlab_engine_queue = None
+    if FRAME_DECODER == 'matlab':
+        matlab_engine_queue = queue.Queue()
+        for engine_name in MATLAB_SESSION_NAMES:
+            print(f"Connecting to engine {engine_name}... ", end='')
+            matlab_engine = matlab.engine.connect_matlab(engine_name)
+            matlab_engine.cd(MATLAB_OFDM_DECODER, nargout=0)
+            matlab_engine_queue.put(matlab_engine)
+            print("connected")
 
     # Work throughe each session (aka training / testing epochs)
     for session_name in sessions:
@@ -323,7 +663,7 @@ def main():
             print(f"Session {session_name} already completed.")
             continue
         else: 
-            process_session(matlab_engine_queue, session_name, preamble_len, node_ids, node_macs)
+            process_session(matlab_engine_queue, session_name, preamble_len, node_ids, node_macs, manifest)
 
 # def eval():
 #     # Check if a directory to store final dataset exists and create if not